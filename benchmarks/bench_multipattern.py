@@ -0,0 +1,85 @@
+#! /usr/bin/env python3
+# Per-file cost of Contains/EndsWith matching as wordlists grow toward full Snaffler size
+# Usage: python3 benchmarks/bench_multipattern.py [files]
+
+import os
+import sys
+import random
+import string
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import credhunt
+
+SIZES = [0, 100, 500, 1000, 2500, 5000]
+
+
+def synthetic_words(count: int) -> list:
+	'''Return random lowercase words shaped like Snaffler name fragments'''
+	alphabet = string.ascii_lowercase + "_-."
+	return ["".join(random.choice(alphabet) for _ in range(random.randint(4, 12))) for _ in range(count)]
+
+
+def sample_paths(count: int) -> list:
+	'''Return random share paths'''
+	folders = ["it", "backup", "scripts", "users", "deploy", "finance", "public", "archive", "2021", "old"]
+	paths = []
+	for _ in range(count):
+		depth = random.randint(1, 8)
+		name = "".join(random.choice(string.ascii_lowercase) for _ in range(random.randint(4, 16)))
+		paths.append("/" + "/".join(random.choice(folders) for _ in range(depth)) + "/" + name + ".txt")
+	return paths
+
+
+def grown_rules(extra: int) -> list:
+	'''Return the FileName rules with extra words spread over the Contains and EndsWith rules'''
+	rules = [dict(rule) for rule in credhunt.RULES["FileName"]]
+	grow = [rule for rule in rules if rule["match_type"] in ("Contains", "EndsWith")]
+	for i, word in enumerate(synthetic_words(extra)):
+		rule = grow[i % len(grow)]
+		rule["wordlist"] = list(rule["wordlist"]) + [word]
+	return rules
+
+
+def naive(rules: list, target: str) -> list:
+	'''Per rule, per word scan used before the automaton'''
+	t = target.lower()
+	hits = []
+	for rule in rules:
+		if rule["match_type"] == "Contains":
+			for word in rule["wordlist"]:
+				if word in t:
+					hits.append(rule["rule"])
+					break
+		elif rule["match_type"] == "EndsWith":
+			for word in rule["wordlist"]:
+				if t.endswith(word):
+					hits.append(rule["rule"])
+					break
+	return hits
+
+
+def per_file_us(function, paths: list) -> float:
+	'''Return microseconds per call of function over paths'''
+	seconds = min(timeit.repeat(lambda: [function(p) for p in paths], number=1, repeat=5))
+	return seconds / len(paths) * 1e6
+
+
+def main() -> None:
+	'''Print per-file cost for each backend and wordlist size'''
+	random.seed(0)
+	paths = sample_paths(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
+	backends = ["naive", "python"] + (["pyahocorasick"] if credhunt.ahocorasick else [])
+	print(f'{"words":>8}' + "".join(f"{b:>16}" for b in backends) + "   (us/file)")
+	for extra in SIZES:
+		rules = grown_rules(extra)
+		count = sum(len(r["wordlist"]) for r in rules if r["match_type"] in ("Contains", "EndsWith"))
+		row = [per_file_us(lambda p: naive(rules, p), paths)]
+		row.append(per_file_us(credhunt.RuleMatcher(rules, accelerated=False).match, paths))
+		if credhunt.ahocorasick:
+			row.append(per_file_us(credhunt.RuleMatcher(rules).match, paths))
+		print(f"{count:>8}" + "".join(f"{t:>16.2f}" for t in row))
+
+
+if __name__ == "__main__":
+	main()
@@ -4,1466 +4,3641 @@
 # sudo cp credhunt.py /usr/lib/python3/dist-packages/cme/modules/
 # Usage: crackmapexec smb <TARGET(S)> -u '<USER>' -p '<PASSWORD>' -d '<DOMAIN>' -M credhunt
 
+import os
 import re
+import html
+import codecs
+import json
 import time
+import queue
+import pickle
+import random
+import struct
+import hashlib
+import sqlite3
 import datetime
-from cme.protocols.smb.remotefile import RemoteFile
-from impacket.smb3structs import FILE_READ_DATA
-from impacket.smbconnection import SessionError
+import itertools
+import threading
+import zlib
+try:
+	from re import _parser as sre_parse
+except ImportError:
+	import sre_parse
+from collections import deque, OrderedDict
+from impacket.nt_errors import STATUS_SUCCESS, STATUS_END_OF_FILE, STATUS_USER_SESSION_DELETED, STATUS_NETWORK_SESSION_EXPIRED, STATUS_NETWORK_NAME_DELETED, STATUS_CONNECTION_DISCONNECTED, STATUS_CONNECTION_RESET
+from impacket.nmb import NetBIOSError, NetBIOSTimeout
+from impacket.smb import SessionError as SMBSessionError
+from impacket.smb3 import SMB3, SessionError as SMB3SessionError
+from impacket.smb3structs import FILE_READ_DATA, SMB2_READ, SMB2_DIALECT_002, SMB2Read, SMB2Read_Response
+from impacket.smbconnection import SMBConnection, SessionError
+try:
+	import ahocorasick
+except ImportError:
+	ahocorasick = None
+try:
+	from cryptography.hazmat.primitives.serialization import pkcs12
+except ImportError:
+	pkcs12 = None
+try:
+	import tomllib
+except ImportError:
+	try:
+		import tomli as tomllib
+	except ImportError:
+		tomllib = None
+
+# Snaffler rules modified for Python
+RULES = {
+	'ShareName': [
+		{
+			'rule': 'DiscardNonFileShares',
+			'target': 'ShareName',
+			'match_type': 'EndsWith',
+			'action': 'Discard',
+			'triage': 'Green',
+			'wordlist': [
+				'\\print$',
+				'\\ipc$'
+			]
+		},
+		{
+			'rule': 'KeepInterestingShareByName',
+			'target': 'ShareName',
+			'match_type': 'EndsWith',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'\\netlogon',
+				'\\sysvol',
+				'\\c$',
+				'\\admin$',
+				'\\sccmcontentlib$'
+			]
+		},
+		{
+			'rule': 'DiscardInterestingShareByName',
+			'target': 'ShareName',
+			'match_type': 'EndsWith',
+			'action': 'Discard',
+			'triage': 'Green',
+			'wordlist': [
+				'\\netlogon',
+				'\\sysvol',
+				'\\c$',
+				'\\admin$',
+				'\\sccmcontentlib$'
+			]}
+	],
+	'FilePath': [
+		{
+			'rule': 'KeepSSHFilesByPath',
+			'target': 'FilePath',
+			'match_type': 'Contains',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'/\\.ssh/'
+			]
+		},
+		{
+			'rule': 'KeepDomainJoinCredsByPath',
+			'target': 'FilePath',
+			'match_type': 'Contains',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'control/customsettings.ini'
+			]
+		},
+		{
+			'rule': 'KeepSCCMBootVarCredsByPath',
+			'target': 'FilePath',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'reminst/smstemp/.*\\.var',
+				'sms/data/variables.dat',
+				'sms/data/policy.xml'
+			]
+		},
+		{
+			'rule': 'KeepCloudApiKeysByPath',
+			'target': 'FilePath',
+			'match_type': 'Contains',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'/\\.aws/',
+				'doctl/config.yaml'
+			]}
+	],
+	'FileName': [
+		{
+			'rule': 'DiscardFalsePositiveByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Discard',
+			'triage': 'Green',
+			'wordlist': [
+				'credentialprovider.idl',
+				'pspasswd64.exe',
+				'pspasswd.exe',
+				'psexec.exe',
+				'psexec64.exe',
+				'jmxremote.password.template',
+				'sceregvl.inf'
+			]
+		},
+		{
+			'rule': 'KeepFtpClientConfigConfigByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'recentservers.xml',
+				'sftp-config.json'
+			]
+		},
+		{
+			'rule': 'KeepWinHashesByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'ntds.dit',
+				'system',
+				'sam',
+				'security'
+			]
+		},
+		{
+			'rule': 'KeepDbMgtConfigByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'sqlstudio.bin',
+				'.mysql_history',
+				'.psql_history',
+				'.pgpass',
+				'.dbeaver-data-sources.xml',
+				'credentials-config.json',
+				'dbvis.xml',
+				'robomongo.json'
+			]
+		},
+		{
+			'rule': 'KeepShellHistoryByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Green',
+			'wordlist': [
+				'.bash_history',
+				'.zsh_history',
+				'.sh_history',
+				'zhistory',
+				'.irb_history',
+				'consolehost_history.txt'
+			]
+		},
+		{
+			'rule': 'KeepRubyByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'database.yml',
+				'.secret_token.rb',
+				'knife.rb',
+				'carrierwave.rb',
+				'omniauth.rb'
+			]
+		},
+		{
+			'rule': 'KeepMemDumpByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'memory.dmp',
+				'hiberfil.sys',
+				'lsass.dmp',
+				'lsass.exe.dmp'
+			]
+		},
+		{
+			'rule': 'KeepRemoteAccessConfByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'mobaxterm.ini',
+				'mobaxterm backup.zip',
+				'confcons.xml'
+			]
+		},
+		{
+			'rule': 'KeepSSHKeysByFileName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'id_rsa',
+				'id_dsa',
+				'id_ecdsa',
+				'id_ed25519'
+			]
+		},
+		{
+			'rule': 'KeepConfigByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'.htpasswd'
+			]
+		},
+		{
+			'rule': 'CertContentByEnding',
+			'target': 'FileName',
+			'match_type': 'EndsWith',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'_rsa',
+				'_dsa',
+				'_ed25519',
+				'_ecdsa'
+			],
+			'relay_configs': [
+				'KeepInlinePrivateKey'
+			]
+		},
+		{
+			'rule': 'KeepShellRcFilesByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Green',
+			'wordlist': [
+				'.netrc',
+				'_netrc',
+				'.exports',
+				'.functions',
+				'.extra',
+				'.npmrc',
+				'.env',
+				'.bashrc',
+				'.profile',
+				'.zshrc'
+			]
+		},
+		{
+			'rule': 'KeepNetConfigFileByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'running-config.cfg',
+				'startup-config.cfg',
+				'running-config',
+				'startup-config'
+			]
+		},
+		{
+			'rule': 'RelayUnattendXml',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'unattend.xml',
+				'autounattend.xml'
+			],
+			'relay_configs': [
+				'KeepUnattendXmlRegexRed'
+			]
+		},
+		{
+			'rule': 'RelayNetConfigByName',
+			'target': 'FileName',
+			'match_type': 'Contains',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'cisco',
+				'router',
+				'firewall',
+				'switch'
+			],
+			'relay_configs': [
+				'KeepNetConfigCreds'
+			]
+		},
+		{
+			'rule': 'KeepDomainJoinCredsByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Yellow',
+			'wordlist': [
+				'customsettings.ini'
+			]
+		},
+		{
+			'rule': 'KeepFtpServerConfigByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'proftpdpasswd',
+				'filezilla.xml'
+			]
+		},
+		{
+			'rule': 'KeepDefenderConfigByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Yellow',
+			'wordlist': [
+				'sensorconfiguration.json',
+				'mdatp_managed.json'
+			]
+		},
+		{
+			'rule': 'KeepPasswordFilesByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'passwords.txt',
+				'pass.txt',
+				'accounts.txt',
+				'passwords.doc',
+				'pass.doc',
+				'accounts.doc',
+				'passwords.xls',
+				'pass.xls',
+				'accounts.xls',
+				'passwords.docx',
+				'pass.docx',
+				'accounts.docx',
+				'passwords.xlsx',
+				'pass.xlsx',
+				'accounts.xlsx',
+				'secrets.txt',
+				'secrets.doc',
+				'secrets.xls',
+				'secrets.docx',
+				'secrets.xlsx'
+			]
+		},
+		{
+			'rule': 'KeepNameContainsGreen',
+			'target': 'FileName',
+			'match_type': 'Contains',
+			'action': 'Snaffle',
+			'triage': 'Green',
+			'wordlist': [
+				'passw',
+				'secret',
+				'credential',
+				'thycotic',
+				'cyberark'
+			]
+		},
+		{
+			'rule': 'KeepPhpByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'localsettings.php'
+			]
+		},
+		{
+			'rule': 'KeepFfLoginsJsonRelay',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'logins.json'
+			],
+			'relay_configs': [
+				'KeepFFRegexRed'
+			]
+		},
+		{
+			'rule': 'KeepJenkinsByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'jenkins.plugins.publish_over_ssh.bapsshpublisherplugin.xml',
+				'credentials.xml'
+			]
+		},
+		{
+			'rule': 'KeepCyberArkConfigsByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'psmapp.cred',
+				'psmgw.cred',
+				'backup.key',
+				'masterreplicationuser.pass',
+				'recprv.key',
+				'replicationuser.pass',
+				'server.key',
+				'vaultemergency.pass',
+				'vaultuser.pass',
+				'vault.ini',
+				'padr.ini',
+				'paragent.ini',
+				'cacpmscanner.exe.config',
+				'pvconfiguration.xml'
+			]
+		},
+		{
+			'rule': 'KeepNixLocalHashesByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'shadow',
+				'pwd.db',
+				'passwd'
+			]
+		},
+		{
+			'rule': 'KeepPSHistoryByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'consolehost_history.txt'
+			],
+			'relay_configs': [
+				'KeepPsCredentials',
+				'KeepCmdCredentials',
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw'
+			]
+		},
+		{
+			'rule': 'KeepGitCredsByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'.git-credentials'
+			]
+		},
+		{
+			'rule': 'KeepKerberosCredentialsByName',
+			'target': 'FileName',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Yellow',
+			'wordlist': [
+				'krb5cc_.*'
+			]
+		},
+		{
+			'rule': 'KeepCloudApiKeysByName',
+			'target': 'FileName',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'.tugboat'
+			]}
+	],
+	'FileExtension': [
+		{
+			'rule': 'DiscardExtExact',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Discard',
+			'triage': 'Green',
+			'wordlist': [
+				'.bmp', '.eps', '.gif', '.ico', '.jfi', '.jfif', '.jif', '.jpe',
+				'.jpeg', '.jpg', '.png', '.psd', '.svg', '.tif', '.tiff', '.webp',
+				'.xcf', '.ttf', '.otf', '.lock', '.css', '.less', '.admx', '.adml',
+				'.xsd', '.nse', '.xsl'
+			]
+		},
+		{
+			'rule': 'RelayCertByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'CheckForKeys',
+			'triage': 'Red',
+			'wordlist': [
+				'.pem',
+				'.der',
+				'.pfx',
+				'.pk12',
+				'.p12',
+				'.pkcs12',
+				'.pem.bak'
+			]
+		},
+		{
+			'rule': 'KeepCyberArkByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'.cred',
+				'.pass'
+			]
+		},
+		{
+			'rule': 'KeepDatabaseByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Yellow',
+			'wordlist': [
+				'.mdf',
+				'.sdf',
+				'.sqldump',
+				'.bak'
+			]
+		},
+		{
+			'rule': 'KeepInfraAsCodeByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'.cscfg',
+				'.tfvars'
+			]
+		},
+		{
+			'rule': 'RelayRdpByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.rdp'
+			],
+			'relay_configs': [
+				'KeepRdpPasswords'
+			]
+		},
+		{
+			'rule': 'RelayJsByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.js',
+				'.cjs',
+				'.mjs',
+				'.cs',
+				'.ts',
+				'.tsx',
+				'.ls',
+				'.es6',
+				'.es'
+			],
+			'relay_configs': [
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw'
+			]
+		},
+		{
+			'rule': 'RelayCSharpByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.aspx',
+				'.ashx',
+				'.asmx',
+				'.asp',
+				'.cshtml',
+				'.cs',
+				'.ascx',
+				'.config'
+			],
+			'relay_configs': [
+				'KeepCSharpDbConnStringsYellow',
+				'KeepCSharpDbConnStringsRed',
+				'KeepCSharpViewstateKeys',
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw',
+				'KeepCSharpDbConnStringsRed',
+				'KeepCSharpDbConnStringsYellow'
+			]
+		},
+		{
+			'rule': 'KeepDeployImageByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Yellow',
+			'wordlist': [
+				'.wim',
+				'.ova',
+				'.ovf'
+			]
+		},
+		{
+			'rule': 'RelayShellScriptByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.netrc',
+				'.exports',
+				'.functions',
+				'.extra',
+				'.npmrc',
+				'.env',
+				'.bashrc',
+				'.profile',
+				'.zshrc',
+				'.bash_history',
+				'.zsh_history',
+				'.sh_history',
+				'zhistory',
+				'.irb_history'
+			],
+			'relay_configs': [
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation'
+			]
+		},
+		{
+			'rule': 'RelayPerlByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.pl'
+			],
+			'relay_configs': [
+				'KeepPerlDbConnStrings',
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw'
+			]
+		},
+		{
+			'rule': 'KeepSSHKeysByFileExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'.ppk'
+			]
+		},
+		{
+			'rule': 'RelayConfigByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.yaml',
+				'.yml',
+				'.toml',
+				'.xml',
+				'.json',
+				'.config',
+				'.ini',
+				'.inf',
+				'.cnf',
+				'.conf',
+				'.properties',
+				'.env',
+				'.dist',
+				'.txt',
+				'.sql',
+				'.log',
+				'.sqlite',
+				'.sqlite3',
+				'.fdb',
+				'.tfvars'
+			],
+			'relay_configs': [
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw'
+			]
+		},
+		{
+			'rule': 'RelayInfraConfigByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.xml',
+				'.json',
+				'.config',
+				'.ini',
+				'.inf',
+				'.cnf',
+				'.conf',
+				'.txt'
+			],
+			'relay_configs': [
+				'KeepNetConfigCreds'
+			]
+		},
+		{
+			'rule': 'KeepKerberosCredentialsByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Yellow',
+			'wordlist': [
+				'.keytab',
+				'.ccache'
+			]
+		},
+		{
+			'rule': 'RelayVBScriptByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.vbs',
+				'.vbe',
+				'.wsf',
+				'.wsc',
+				'.asp',
+				'.hta'
+			],
+			'relay_configs': [
+				'KeepCmdCredentials',
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw',
+				'KeepCSharpDbConnStringsRed',
+				'KeepCSharpDbConnStringsYellow'
+			]
+		},
+		{
+			'rule': 'RelayRubyByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.rb'
+			],
+			'relay_configs': [
+				'KeepRubyDbConnStrings',
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw'
+			]
+		},
+		{
+			'rule': 'KeepRemoteAccessConfByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Yellow',
+			'wordlist': [
+				'.rdg',
+				'.rtsz',
+				'.rtsx',
+				'.ovpn',
+				'.tvopt',
+				'.sdtid'
+			]
+		},
+		{
+			'rule': 'RelayPsByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.psd1',
+				'.psm1',
+				'.ps1'
+			],
+			'relay_configs': [
+				'KeepPsCredentials',
+				'KeepCmdCredentials',
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw'
+			]
+		},
+		{
+			'rule': 'RelayJavaByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.jsp',
+				'.do',
+				'.java',
+				'.cfm'
+			],
+			'relay_configs': [
+				'KeepJavaDbConnStrings',
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw'
+			]
+		},
+		{
+			'rule': 'RelayPythonByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.py'
+			],
+			'relay_configs': [
+				'KeepPyDbConnStrings',
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw'
+			]
+		},
+		{
+			'rule': 'RelayPhpByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.php',
+				'.phtml',
+				'.inc',
+				'.php3',
+				'.php5',
+				'.php7'
+			],
+			'relay_configs': [
+				'KeepPhpDbConnStrings',
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw'
+			]
+		},
+		{
+			'rule': 'KeepPcapByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Yellow',
+			'wordlist': [
+				'.pcap',
+				'.cap',
+				'.pcapng'
+			]
+		},
+		{
+			'rule': 'RelayCmdByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.bat',
+				'.cmd'
+			],
+			'relay_configs': [
+				'KeepCmdCredentials',
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation'
+			]
+		},
+		{
+			'rule': 'RelayOfficeDocsByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Relay',
+			'triage': 'Green',
+			'wordlist': [
+				'.docx',
+				'.docm',
+				'.dotx',
+				'.xlsx',
+				'.xlsm',
+				'.pptx',
+				'.pptm',
+				'.odt',
+				'.ods',
+				'.odp'
+			],
+			'relay_configs': [
+				'KeepCmdCredentials',
+				'KeepPsCredentials',
+				'KeepNetConfigCreds',
+				'KeepAwsKeysInCode',
+				'KeepInlinePrivateKey',
+				'KeepPassOrKeyInCode',
+				'KeepSlackTokensInCode',
+				'KeepSqlAccountCreation',
+				'KeepDbConnStringPw'
+			]
+		},
+		{
+			'rule': 'KeepPassMgrsByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Black',
+			'wordlist': [
+				'.kdbx',
+				'.kdb',
+				'.psafe3',
+				'.kwallet',
+				'.keychain',
+				'.agilekeychain',
+				'.cred'
+			]
+		},
+		{
+			'rule': 'KeepMemDumpByExtension',
+			'target': 'FileExtension',
+			'match_type': 'Exact',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				'.dmp'
+			]}
+	],
+	'Relay': {
+		'KeepPassOrKeyInCode': {
+			'rule': 'KeepPassOrKeyInCode',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'passw?o?r?d\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
+				b'api[Kk]ey\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
+				b'passw?o?r?d?>\\s*[^\\s<]+\\s*<',
+				b'passw?o?r?d?>.{3,2000}</pass',
+				b'api[kK]ey>\\s*[^\\s<]+\\s*<',
+				b'[_\\-\\.]oauth\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
+				b'client_secret\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
+				b'<ExtendedMatchKey>ClientAuth'
+			]
+		},
+		'KeepPyDbConnStrings': {
+			'rule': 'KeepPyDbConnStrings',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'mysql\\.connector\\.connect\\(',
+				b'psycopg2\\.connect\\('
+			]
+		},
+		'KeepRubyDbConnStrings': {
+			'rule': 'KeepRubyDbConnStrings',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'DBI\\.connect\\('
+			]
+		},
+		'KeepCSharpViewstateKeys': {
+			'rule': 'KeepCSharpViewstateKeys',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'validationkey\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
+				b'decryptionkey\\s*=\\s*[\\\'\\"][^\\\'\\"]....'
+			]
+		},
+		'KeepRdpPasswords': {
+			'rule': 'KeepRdpPasswords',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'password 51\\:b'
+			]
+		},
+		'KeepJavaDbConnStrings': {
+			'rule': 'KeepJavaDbConnStrings',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'\\.getConnection\\(\\"jdbc\\:',
+				b'passwo?r?d\\s*=\\s*[\\\'\\"][^\\\'\\"]....'
+			]
+		},
+		'KeepCSharpDbConnStringsYellow': {
+			'rule': 'KeepCSharpDbConnStringsYellow',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Yellow',
+			'wordlist': [
+				b'Data Source=.+Integrated Security=(SSPI|true)',
+				b'Integrated Security=(SSPI|true);.*Data Source=.+'
+			]
+		},
+		'KeepCSharpDbConnStringsRed': {
+			'rule': 'KeepCSharpDbConnStringsRed',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'Data Source=.+(;|)Password=.+(;|)',
+				b'Password=.+(;|)Data Source=.+(;|)'
+			]
+		},
+		'KeepS3UriPrefixInCode': {
+			'rule': 'KeepS3UriPrefixInCode',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Yellow',
+			'wordlist': [
+				b's3[a]?:\\/\\/[a-zA-Z0-9\\-\\+\\/]{2,16}'
+			]
+		},
+		'KeepDbConnStringPw': {
+			'rule': 'KeepDbConnStringPw',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Yellow',
+			'wordlist': [
+				b'connectionstring.{1,200}passw'
+			]
+		},
+		'KeepUnattendXmlRegexRed': {
+			'rule': 'KeepUnattendXmlRegexRed',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'(?s)<AdministratorPassword>.{0,30}<Value>.*<\\/Value>',
+				b'(?s)<AutoLogon>.{0,30}<Value>.*<\\/Value>'
+			]
+		},
+		'KeepPsCredentials': {
+			'rule': 'KeepPsCredentials',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'-SecureString',
+				b'-AsPlainText',
+				b'\\[Net.NetworkCredential\\]::new\\('
+			]
+		},
+		'KeepCmdCredentials': {
+			'rule': 'KeepCmdCredentials',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'passwo?r?d\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
+				b'schtasks.{1,300}(/rp\\s|/p\\s)',
+				b'net user ',
+				b'psexec .{0,100} -p ',
+				b'net use .{0,300} /user:',
+				b'cmdkey '
+			]
+		},
+		'KeepPhpDbConnStrings': {
+			'rule': 'KeepPhpDbConnStrings',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'mysql_connect\\s*\\(.*\\$.*\\)',
+				b'mysql_pconnect\\s*\\(.*\\$.*\\)',
+				b'mysql_change_user\\s*\\(.*\\$.*\\)',
+				b'pg_connect\\s*\\(.*\\$.*\\)',
+				b'pg_pconnect\\s*\\(.*\\$.*\\)'
+			]
+		},
+		'KeepInlinePrivateKey': {
+			'rule': 'KeepInlinePrivateKey',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'-----BEGIN( RSA| OPENSSH| DSA| EC| PGP)? PRIVATE KEY( BLOCK)?-----'
+			]
+		},
+		'KeepFFRegexRed': {
+			'rule': 'KeepFFRegexRed',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'"encryptedPassword":"[A-Za-z0-9+/=]+"'
+			]
+		},
+		'KeepSlackTokensInCode': {
+			'rule': 'KeepSlackTokensInCode',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'(xox[pboa]-[0-9]{12}-[0-9]{12}-[0-9]{12}-[a-z0-9]{32})',
+				b'https://hooks.slack.com/services/T[a-zA-Z0-9_]{8}/B[a-zA-Z0-9_]{8}/[a-zA-Z0-9_]{24}'
+			]
+		},
+		'KeepNetConfigCreds': {
+			'rule': 'KeepNetConfigCreds',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'NVRAM config last updated',
+				b'enable password \\.',
+				b'simple-bind authenticated encrypt',
+				b'pac key [0-7] ',
+				b'snmp-server community\\s.+\\sRW'
+			]
+		},
+		'KeepAwsKeysInCode': {
+			'rule': 'KeepAwsKeysInCode',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'aws[_\\-\\.]?key',
+				b'(\\s|\\\'|\\"|\\^|=)(A3T[A-Z0-9]|AKIA|AGPA|AROA|AIPA|ANPA|ANVA|ASIA)[A-Z2-7]{12,16}(\\s|\\\'|\\"|$)'
+			]
+		},
+		'KeepSqlAccountCreation': {
+			'rule': 'KeepSqlAccountCreation',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'CREATE (USER|LOGIN) .{0,200} (IDENTIFIED BY|WITH PASSWORD)'
+			]
+		},
+		'KeepPerlDbConnStrings': {
+			'rule': 'KeepPerlDbConnStrings',
+			'target': 'FileContentAsString',
+			'match_type': 'Regex',
+			'action': 'Snaffle',
+			'triage': 'Red',
+			'wordlist': [
+				b'DBI\\-\\>connect\\('
+			]
+		}
+	}
+}
+
+
+FILE_CATEGORIES = ("FilePath", "FileName", "FileExtension")
+RULE_CATEGORIES = ("ShareName",) + FILE_CATEGORIES
+CONTENT_TARGET = "FileContentAsString"
+MATCH_TYPES = ("Exact", "Contains", "StartsWith", "EndsWith", "Regex")
+RULE_ACTIONS = ("Snaffle", "Relay", "Discard", "CheckForKeys")
+TRIAGE_ORDER = ("Black", "Red", "Yellow", "Green")
+_LEADING_FLAGS = re.compile(r'^\(\?([imsx]+)\)')
+_LEADING_FLAGS_BYTES = re.compile(rb'^\(\?([imsx]+)\)')
+
+
+def _scoped_pattern(pattern):
+	'''Rewrite leading inline flags like (?s) as a scoped group so the pattern can be alternated'''
+	flags = (_LEADING_FLAGS_BYTES if isinstance(pattern, bytes) else _LEADING_FLAGS).match(pattern)
+	if not flags:
+		return pattern
+	colon, close = (b":", b")") if isinstance(pattern, bytes) else (":", ")")
+	return pattern[:flags.end() - 1] + colon + pattern[flags.end():] + close
+
+
+def _max_width(regex) -> int:
+	'''Return the longest possible match of a compiled regex, or None if unbounded'''
+	width = sre_parse.parse(regex.pattern, regex.flags).getwidth()[1]
+	if width >= sre_parse.MAXREPEAT:
+		return None
+	return width
+
+
+def _alternation(patterns: list, suffix=""):
+	'''Return one case-insensitive regex matching if any of the patterns match, or None'''
+	if not patterns:
+		return None
+	if isinstance(patterns[0], bytes):
+		joined = b"|".join(b"(?:" + _scoped_pattern(p) + b")" for p in patterns)
+		return re.compile(b"(?:" + joined + b")" + suffix.encode(), re.I)
+	joined = "|".join("(?:" + _scoped_pattern(p) + ")" for p in patterns)
+	return re.compile("(?:" + joined + ")" + suffix, re.I)
+
+
+def _combinable(pattern) -> bool:
+	'''Return True if a regex matches the same inside an alternation, having no named groups or backreferences'''
+	parsed = sre_parse.parse(pattern)
+	if parsed.state.groupdict:
+		return False
+	# Group numbers shift once the pattern follows others
+	stack = [parsed]
+	while stack:
+		for op, av in stack.pop():
+			if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+				return False
+			items = [av]
+			while items:
+				item = items.pop()
+				if isinstance(item, sre_parse.SubPattern):
+					stack.append(item)
+				elif isinstance(item, (tuple, list)):
+					items.extend(item)
+	return True
+
+
+def _gate(patterns: list):
+	'''Return the alternation rejecting targets none of the patterns match in one search, or None if they cannot be combined'''
+	if not all(_combinable(pattern) for pattern in patterns):
+		return None
+	return _alternation(patterns)
+
+
+class MultiPatternMatcher:
+	'''Aho-Corasick automaton that finds every word of a wordlist in one pass'''
+
+	def __init__(self, words: dict, accelerated: bool = True) -> None:
+		'''Build the automaton from a mapping of word to payload'''
+		self.size = len(words)
+		self.accelerated = accelerated and ahocorasick is not None
+		if self.accelerated:
+			self._automaton = ahocorasick.Automaton()
+			for word, payload in words.items():
+				self._automaton.add_word(word, (word, payload))
+			self._automaton.make_automaton()
+		else:
+			self._build(words)
+
+	def _build(self, words: dict) -> None:
+		'''Build goto, failure and output tables for the pure Python automaton'''
+		goto = [{}]
+		output = [[]]
+		for word, payload in words.items():
+			state = 0
+			for char in word:
+				nxt = goto[state].get(char)
+				if nxt is None:
+					nxt = len(goto)
+					goto[state][char] = nxt
+					goto.append({})
+					output.append([])
+				state = nxt
+			output[state].append((word, payload))
+		fail = [0] * len(goto)
+		queue = list(goto[0].values())
+		for state in queue:
+			for char, nxt in goto[state].items():
+				queue.append(nxt)
+				f = fail[state]
+				while f and char not in goto[f]:
+					f = fail[f]
+				fail[nxt] = goto[f].get(char, 0)
+				output[nxt] = output[nxt] + output[fail[nxt]]
+		self._goto = goto
+		self._fail = fail
+		self._output = [tuple(o) for o in output]
+
+	def iter(self, text: str):
+		'''Yield (end index, word, payload) for every occurrence of a word in text'''
+		if not self.size:
+			return
+		if self.accelerated:
+			for end, (word, payload) in self._automaton.iter(text):
+				yield end, word, payload
+			return
+		goto = self._goto
+		fail = self._fail
+		output = self._output
+		state = 0
+		for end, char in enumerate(text):
+			while state and char not in goto[state]:
+				state = fail[state]
+			state = goto[state].get(char, 0)
+			for word, payload in output[state]:
+				yield end, word, payload
+
+
+class RuleMatcher:
+	'''Prebuilt matcher for all the rules of one file category'''
+
+	__slots__ = ("rules", "exact", "regex", "regex_gate", "words")
+
+	def __init__(self, rules: list, accelerated: bool = True) -> None:
+		'''Compile the wordlists of every rule once'''
+		self.rules = tuple(rules)
+		exact = {}
+		regex = []
+		# word -> (rule index, wordlist position, match type)
+		words = {}
+		for index, rule in enumerate(self.rules):
+			match_type = rule["match_type"]
+			if match_type == "Exact":
+				for word in rule["wordlist"]:
+					indexes = exact.setdefault(word.lower(), [])
+					if index not in indexes:
+						indexes.append(index)
+			elif match_type == "Regex":
+				regex.append((index, tuple(re.compile(word, re.I) for word in rule["wordlist"])))
+			elif match_type in ("Contains", "StartsWith", "EndsWith"):
+				for position, word in enumerate(rule["wordlist"]):
+					words.setdefault(word.lower(), []).append((index, position, match_type))
+		self.exact = {word: tuple(indexes) for word, indexes in exact.items()}
+		self.regex = tuple(regex)
+		# Combined gate rejects the common no-match case in a single search
+		self.regex_gate = _gate([p.pattern for _, patterns in regex for p in patterns])
+		self.words = MultiPatternMatcher({word: tuple(targets) for word, targets in words.items()}, accelerated)
+
+	def match(self, target: str) -> list:
+		'''Return (rule, match) for every rule matching target, in rule order'''
+		lowered = target.lower()
+		hits = [(index, lowered) for index in self.exact.get(lowered, ())]
+		if self.regex and (self.regex_gate is None or self.regex_gate.search(target)):
+			for index, patterns in self.regex:
+				for pattern in patterns:
+					found = pattern.search(target)
+					if found:
+						hits.append((index, found.group()))
+						break
+		# Contains, StartsWith and EndsWith words of all rules in a single pass,
+		# keeping the earliest wordlist entry per rule
+		found = {}
+		last = len(lowered) - 1
+		for end, word, targets in self.words.iter(lowered):
+			for index, position, match_type in targets:
+				if match_type == "EndsWith" and end != last:
+					continue
+				if match_type == "StartsWith" and end != len(word) - 1:
+					continue
+				if index not in found or position < found[index][0]:
+					found[index] = (position, word)
+		hits.extend((index, word) for index, (_, word) in found.items())
+		if len(hits) > 1:
+			hits.sort(key=lambda hit: hit[0])
+		return [(self.rules[index], match) for index, match in hits]
+
+	def match_all(self, targets: tuple) -> list:
+		'''Return (rule, match) for every rule matching any of the targets, once per rule and for the first target it matches'''
+		hits = []
+		seen = set()
+		for target in targets:
+			for rule, match in self.match(target):
+				if id(rule) not in seen:
+					seen.add(id(rule))
+					hits.append((rule, match))
+		return hits
+
+
+class DiscardFilter:
+	'''Discard rules of the file categories and a size limit, checked before any triage'''
+
+	def __init__(self, rules: dict) -> None:
+		'''Compile the Discard rules of each file category'''
+		self.matchers = []
+		# Cheapest target first, a file is dropped on the first match
+		for category in ("FileExtension", "FileName", "FilePath"):
+			discard = [rule for rule in rules.get(category, []) if rule["action"] == "Discard"]
+			if discard:
+				self.matchers.append((category, RuleMatcher(discard)))
+
+	def discards(self, path: str, filename: str, exts: tuple, size: int = None, max_size: int = 0) -> bool:
+		'''Return True if a file is over max_size or one of its name, path or extensions matches a Discard rule'''
+		if max_size and size is not None and size > max_size:
+			return True
+		targets = {"FileExtension": exts, "FileName": (filename,), "FilePath": (path,)}
+		for category, matcher in self.matchers:
+			if any(matcher.match(target) for target in targets[category]):
+				return True
+		return False
+
+
+class ContentRule:
+	'''Relay content rule with its wordlist compiled once'''
+
+	__slots__ = ("rule", "patterns", "width")
+
+	def __init__(self, rule: dict) -> None:
+		'''Compile the content regexes'''
+		self.rule = rule
+		self.patterns = tuple(re.compile(word, re.I) for word in rule["wordlist"])
+		widths = [_max_width(pattern) for pattern in self.patterns]
+		self.width = None if None in widths else max(widths, default=0)
+
+	def search(self, data: bytes) -> bytes:
+		'''Return the first wordlist match in data or an empty string'''
+		for pattern in self.patterns:
+			found = pattern.search(data)
+			if found:
+				return bytes(found.group())
+		return b""
+
+
+class CompiledRules:
+	'''Rule set compiled into matchers once per process'''
+
+	def __init__(self, rules: dict) -> None:
+		'''Build the category matchers and relay content rules'''
+		self.rules = rules
+		# Discard rules of the file categories run in the pre-filter, not with the triage rules
+		self.categories = {category: RuleMatcher([rule for rule in rules.get(category, []) if category == "ShareName" or rule["action"] != "Discard"]) for category in RULE_CATEGORIES}
+		self.discard = DiscardFilter(rules)
+		# Last suffix -> compound suffixes ending in it that extension rules name, longest first
+		self.compound_suffixes = {}
+		for rule in rules.get("FileExtension", []):
+			for word in rule["wordlist"] if rule["match_type"] == "Exact" else ():
+				if word.count(".") > 1:
+					self.compound_suffixes.setdefault(word[word.rfind("."):].lower(), set()).add(word.lower())
+		self.compound_suffixes = {last: sorted(words, key=len, reverse=True) for last, words in self.compound_suffixes.items()}
+		self.relay = {name: ContentRule(rule) for name, rule in rules["Relay"].items()}
+		self.digest = hashlib.sha1(repr(rules).encode()).hexdigest()
+		self._gates = {}
+
+	def file_exts(self, filename: str) -> tuple:
+		'''Return the extensions of a file name, the compound suffixes named by the extension rules it ends in, longest first, then its last suffix'''
+		dot = filename.rfind(".")
+		if dot < 0:
+			return ("",)
+		lowered = filename.lower()
+		compound = tuple(filename[-len(suffix):] for suffix in self.compound_suffixes.get(lowered[dot:], ()) if lowered.endswith(suffix))
+		return compound + (filename[dot:],)
+
+	def content_gate(self, names: tuple):
+		'''Return the combined regex for a set of relay rules, or None if their patterns must run one by one'''
+		if names not in self._gates:
+			if len(self._gates) >= 1024:
+				self._gates.clear()
+			self._gates[names] = _gate([p.pattern for name in names for p in self.relay[name].patterns])
+		return self._gates[names]
+
+	def scan_content(self, data: bytes, relay_configs: list) -> list:
+		'''Return (rule, match) for every relay rule matching data'''
+		names = tuple(dict.fromkeys(relay_configs))
+		gate = self.content_gate(names)
+		if not data or (gate is not None and not gate.search(data)):
+			return []
+		hits = []
+		for name in names:
+			relay_rule = self.relay[name]
+			match = relay_rule.search(data)
+			if match:
+				hits.append((relay_rule.rule, match))
+		return hits
+
+
+# Bytes of the first block sniffed for a byte order mark, UTF-16 text or binary content
+SNIFF_SIZE = 4096
+BYTE_ORDER_MARKS = ((codecs.BOM_UTF8, None), (codecs.BOM_UTF16_LE, "utf-16-le"), (codecs.BOM_UTF16_BE, "utf-16-be"))
+
+
+class ContentScanner:
+	'''Streams file chunks through relay content rules with a bounded buffer'''
+
+	def __init__(self, compiled: CompiledRules, relay_configs: list, buffer_size: int, sniff: bool = True) -> None:
+		'''Prepare a scan for the given relay rules, sniffing the first chunk for binary content and UTF-16 text unless told not to'''
+		self.compiled = compiled
+		self.pending = tuple(dict.fromkeys(relay_configs))
+		self.hits = []
+		self.buffer_size = max(buffer_size, 2)
+		# Keep enough of the previous window for the longest possible match to
+		# span a window boundary, capped at half the buffer for unbounded regexes
+		widths = [compiled.relay[name].width for name in self.pending]
+		cap = self.buffer_size // 2
+		self.overlap = cap if None in widths else min(max(widths, default=0), cap)
+		self.bytes_scanned = 0
+		self.sniff = sniff
+		self.binary = False
+		# First block held back until it can be sniffed, and the incremental decoder of UTF-16 text, which is scanned as UTF-8
+		self._head = bytearray()
+		self._decoder = None
+		self._buffer = bytearray()
+
+	@property
+	def done(self) -> bool:
+		'''Return True once every relay rule has fired'''
+		return not self.pending
+
+	def flush(self) -> None:
+		'''Scan and drop the buffer so the next chunk starts a new, unrelated window'''
+		if self.sniff and self._head:
+			self._add(self._sniff())
+		if self._buffer and self.pending:
+			self._scan()
+		self._buffer = bytearray()
+		if self._decoder is not None:
+			self._decoder.reset()
+
+	def feed(self, chunk: bytes) -> None:
+		'''Add a chunk of file contents, scanning whenever the buffer fills'''
+		if self.pending:
+			self.bytes_scanned += len(chunk)
+		if self.sniff:
+			self._head += chunk
+			if len(self._head) < SNIFF_SIZE:
+				return
+			chunk = self._sniff()
+		self._add(chunk)
+
+	def _add(self, chunk: bytes) -> None:
+		'''Add sniffed contents to the buffer, scanning whenever it fills'''
+		if self._decoder is not None:
+			chunk = self._decoder.decode(chunk).encode("utf-8")
+		view = memoryview(chunk)
+		while view and self.pending:
+			room = self.buffer_size - len(self._buffer)
+			self._buffer += view[:room]
+			view = view[room:]
+			if len(self._buffer) >= self.buffer_size:
+				self._scan()
+				del self._buffer[:len(self._buffer) - self.overlap]
+
+	def finish(self) -> list:
+		'''Scan what is left in the buffer and return (rule, match) hits'''
+		self.flush()
+		return self.hits
+
+	def _sniff(self) -> bytes:
+		'''Tell text from binary content by the first block, returning what was held back without a byte order mark or nothing for binaries'''
+		chunk = bytes(self._head)
+		self._head = bytearray()
+		self.sniff = False
+		for mark, encoding in BYTE_ORDER_MARKS:
+			if chunk.startswith(mark):
+				if encoding:
+					self._decoder = codecs.getincrementaldecoder(encoding)("replace")
+				return chunk[len(mark):]
+		sample = chunk[:SNIFF_SIZE]
+		half = len(sample) // 2
+		even = sample[0::2].count(0)
+		odd = sample[1::2].count(0)
+		# Mostly ASCII UTF-16 has a NUL in every other byte
+		if half and odd > half * 0.3 and even < half * 0.05:
+			self._decoder = codecs.getincrementaldecoder("utf-16-le")("replace")
+		elif half and even > half * 0.3 and odd < half * 0.05:
+			self._decoder = codecs.getincrementaldecoder("utf-16-be")("replace")
+		# Text has no NUL bytes, nearly every binary has some in its first block
+		elif even + odd:
+			self.binary = True
+			self.pending = ()
+			return b""
+		return chunk
+
+	def _scan(self) -> None:
+		'''Run the pending relay rules over the current buffer'''
+		gate = self.compiled.content_gate(self.pending)
+		if gate is not None and not gate.search(self._buffer):
+			return
+		pending = []
+		for name in self.pending:
+			relay_rule = self.compiled.relay[name]
+			match = relay_rule.search(self._buffer)
+			if match:
+				self.hits.append((relay_rule.rule, match))
+			else:
+				pending.append(name)
+		self.pending = tuple(pending)
+
+
+class XMLTextScanner(ContentScanner):
+	'''Streams the parts of zipped XML documents through relay content rules as text, leaving out the markup'''
+
+	# Tags ending a paragraph, row or cell, or standing for a break or a tab
+	TAG = re.compile(r'<(/?)(?:[\w.-]+:)?([\w.-]*)[^>]*>')
+	BREAKS = {"p": "\n", "br": "\n", "cr": "\n", "h": "\n", "tr": "\n", "row": "\n", "si": "\n", "line-break": "\n", "table-row": "\n", "tab": " ", "s": " ", "tc": " ", "c": " ", "table-cell": " "}
+
+	def __init__(self, compiled: CompiledRules, relay_configs: list, buffer_size: int, max_text: list) -> None:
+		'''Prepare a scan, max_text holding the text bytes the whole document may still yield'''
+		super().__init__(compiled, relay_configs, buffer_size, sniff=False)
+		self.max_text = max_text
+		# The raw XML is decoded here, apart from the decoder of the sniffed text stream
+		self._markup_decoder = codecs.getincrementaldecoder("utf-8")("replace")
+		self._markup = ""
+
+	@property
+	def done(self) -> bool:
+		'''Return True once every relay rule has fired or the document yielded all the text it may'''
+		return super().done or self.max_text[0] <= 0
+
+	def feed(self, chunk: bytes) -> None:
+		'''Add a chunk of the XML part, scanning the text it completes'''
+		markup = self._markup + self._markup_decoder.decode(chunk)
+		# Hold back a tag or entity the chunk cuts in two
+		cut = len(markup)
+		tag = markup.rfind("<")
+		if tag >= 0 and markup.find(">", tag) < 0:
+			cut = tag
+		entity = markup.rfind("&", 0, cut)
+		if entity >= 0 and markup.find(";", entity, cut) < 0 and cut - entity < 12:
+			cut = entity
+		self._markup = markup[cut:]
+		self._feed_text(markup[:cut])
+
+	def finish(self) -> list:
+		'''Scan the text left over and return (rule, match) hits'''
+		self._feed_text(self._markup + self._markup_decoder.decode(b"", True))
+		self._markup = ""
+		return super().finish()
+
+	def _feed_text(self, markup: str) -> None:
+		'''Feed the text of complete markup, up to what the document may still yield'''
+		text = html.unescape(self.TAG.sub(lambda m: self.BREAKS.get(m.group(2), ""), markup)).encode("utf-8")[:max(self.max_text[0], 0)]
+		self.max_text[0] -= len(text)
+		super().feed(text)
+
+
+COMPILED_RULES = CompiledRules(RULES)
+# Bump when the compiled rule classes change so pickled rule sets are rebuilt
+RULE_CACHE_VERSION = 5
+_COMPILED_RULE_SETS = {}
+# .NET named groups (?<name>...) are (?P<name>...) in Python
+_NET_NAMED_GROUP = re.compile(r'\(\?<(?![=!])')
+# An escaped backslash in a Snaffler path regex, or any other escape
+_REGEX_ESCAPE = re.compile(r'\\.', re.S)
+
+
+def _rule_files(paths: list) -> list:
+	'''Return the rule files of a list of files and folders, walking folders in name order'''
+	files = []
+	for path in paths:
+		if not os.path.isdir(path):
+			files.append(path)
+			continue
+		for folder, dirs, names in os.walk(path):
+			dirs.sort()
+			files.extend(os.path.join(folder, name) for name in sorted(names) if name.lower().endswith((".toml", ".json")))
+	return files
+
+
+def _snaffler_rule(entry: dict) -> dict:
+	'''Convert a Snaffler TOML classifier rule to a credhunt rule, or None if its scope is not supported'''
+	if entry.get("EnumerationScope") not in ("ShareEnumeration", "FileEnumeration", "ContentsEnumeration"):
+		return None
+	if entry.get("MatchLocation") not in RULE_CATEGORIES + (CONTENT_TARGET,):
+		return None
+	if entry.get("MatchAction") not in RULE_ACTIONS:
+		return None
+	wordlist = list(entry.get("WordList", []))
+	if entry.get("WordListType") == "Regex":
+		wordlist = [_NET_NAMED_GROUP.sub("(?P<", word) for word in wordlist]
+	if entry.get("MatchLocation") == "FilePath":
+		# Snaffler paths are separated by backslashes, crawled paths by slashes
+		if entry.get("WordListType") == "Regex":
+			wordlist = [_REGEX_ESCAPE.sub(lambda m: "/" if m.group() == "\\\\" else m.group(), word) for word in wordlist]
+		else:
+			wordlist = [word.replace("\\", "/") for word in wordlist]
+	rule = {
+		'rule': entry.get("RuleName"),
+		'target': entry.get("MatchLocation"),
+		'match_type': entry.get("WordListType"),
+		'action': entry.get("MatchAction"),
+		'triage': entry.get("Triage", "Green"),
+		'wordlist': wordlist
+	}
+	if entry.get("RelayTargets"):
+		rule['relay_configs'] = list(entry["RelayTargets"])
+	return rule
+
+
+def load_rule_file(path: str) -> tuple:
+	'''Return the rules of a Snaffler TOML or native JSON rule file and the names of rules it has that are not supported'''
+	with open(path, "rb") as f:
+		text = f.read().decode("utf-8-sig")
+	if not path.lower().endswith(".toml"):
+		loaded = json.loads(text)
+		return (loaded.get("rules", []) if isinstance(loaded, dict) else loaded), []
+	if tomllib is None:
+		raise ValueError(f"{path}: Snaffler TOML rules need Python 3.11 or the tomli package")
+	rules = []
+	skipped = []
+	for entry in tomllib.loads(text).get("ClassifierRules", []):
+		rule = _snaffler_rule(entry)
+		if rule is None:
+			skipped.append(entry.get("RuleName"))
+		else:
+			rules.append(rule)
+	return rules, skipped
+
+
+def _normalize_rule(rule: dict, path: str) -> dict:
+	'''Return a copy of a loaded rule in the form of the built in rules'''
+	missing = [key for key in ("rule", "target", "match_type", "action", "wordlist") if not rule.get(key)]
+	if missing:
+		raise ValueError(f"{path}: rule {rule.get('rule', '?')} is missing {', '.join(missing)}")
+	rule = dict(rule, wordlist=list(rule["wordlist"]))
+	rule.setdefault("triage", "Green")
+	if rule["target"] == CONTENT_TARGET:
+		# Content rules run as byte regexes
+		if rule["match_type"] != "Regex":
+			rule["wordlist"] = [re.escape(word) for word in rule["wordlist"]]
+			rule["match_type"] = "Regex"
+		rule["wordlist"] = [word.encode() if isinstance(word, str) else word for word in rule["wordlist"]]
+	return rule
+
+
+def validate_rules(rules: dict) -> None:
+	'''Raise ValueError for the first rule that cannot be compiled or run'''
+	for category in RULE_CATEGORIES + ("Relay",):
+		for rule in (rules[category].values() if category == "Relay" else rules[category]):
+			name = rule["rule"]
+			if category != "Relay" and rule["target"] != category:
+				raise ValueError(f"Rule {name}: target {rule['target']} in the {category} rules")
+			if rule["match_type"] not in MATCH_TYPES:
+				raise ValueError(f"Rule {name}: unknown match_type {rule['match_type']}")
+			if rule["action"] not in RULE_ACTIONS:
+				raise ValueError(f"Rule {name}: unknown action {rule['action']}")
+			if rule["triage"] not in TRIAGE_ORDER:
+				raise ValueError(f"Rule {name}: unknown triage {rule['triage']}")
+			if rule["match_type"] == "Regex":
+				for word in rule["wordlist"]:
+					try:
+						re.compile(word)
+					except re.error as e:
+						raise ValueError(f"Rule {name}: bad regex {word!r}: {str(e)}")
+			for relay in rule.get("relay_configs", []) if rule["action"] == "Relay" else []:
+				if relay not in rules["Relay"]:
+					raise ValueError(f"Rule {name}: unknown relay rule {relay}")
+		# The regexes of a category also run combined into one gate
+		patterns = [word for rule in (rules[category].values() if category == "Relay" else rules[category]) if rule["match_type"] == "Regex" for word in rule["wordlist"]]
+		try:
+			_gate(patterns)
+		except re.error as e:
+			raise ValueError(f"{category} rules: regexes cannot be combined: {str(e)}")
+
+
+def build_rules(paths: list, include_defaults: bool = True) -> dict:
+	'''Merge rule files over the built in rules, a rule replacing an earlier one of the same name'''
+	rules = {category: list(RULES[category]) if include_defaults else [] for category in RULE_CATEGORIES}
+	rules["Relay"] = dict(RULES["Relay"]) if include_defaults else {}
+	skipped = set()
+	for path in _rule_files(paths):
+		loaded, unsupported = load_rule_file(path)
+		skipped.update(unsupported)
+		for rule in loaded:
+			rule = _normalize_rule(rule, path)
+			if rule["target"] == CONTENT_TARGET:
+				rules["Relay"][rule["rule"]] = rule
+				continue
+			if rule["target"] not in RULE_CATEGORIES:
+				raise ValueError(f"{path}: rule {rule['rule']} has unknown target {rule['target']}")
+			category = rules[rule["target"]]
+			names = [r["rule"] for r in category]
+			if rule["rule"] in names:
+				category[names.index(rule["rule"])] = rule
+			else:
+				category.append(rule)
+	# Relaying to rules of an unsupported scope is not an error, those targets are dropped
+	for category in RULE_CATEGORIES:
+		for rule in rules[category]:
+			if skipped.intersection(rule.get("relay_configs", [])):
+				rule["relay_configs"] = [name for name in rule["relay_configs"] if name not in skipped]
+	validate_rules(rules)
+	return rules
+
+
+def load_compiled_rules(paths: list, include_defaults: bool = True, cache_dir: str = None) -> CompiledRules:
+	'''Return the compiled rules of rule files, reused within the process and pickled in cache_dir by rule file hash'''
+	files = _rule_files(paths)
+	digest = hashlib.sha1(f"{RULE_CACHE_VERSION}|{include_defaults}|{ahocorasick is not None}|{COMPILED_RULES.digest}".encode())
+	for path in files:
+		with open(path, "rb") as f:
+			digest.update(hashlib.sha1(f.read()).digest())
+	key = digest.hexdigest()
+	compiled = _COMPILED_RULE_SETS.get(key)
+	if compiled is not None:
+		return compiled
+	cache_file = os.path.join(cache_dir, f"rules-{key}.pickle") if cache_dir else None
+	if cache_file and os.path.exists(cache_file):
+		try:
+			with open(cache_file, "rb") as f:
+				compiled = pickle.load(f)
+		except Exception:
+			compiled = None
+	if compiled is None:
+		compiled = CompiledRules(build_rules(files, include_defaults))
+		if cache_file:
+			try:
+				with open(cache_file + ".tmp", "wb") as f:
+					pickle.dump(compiled, f, pickle.HIGHEST_PROTOCOL)
+				os.replace(cache_file + ".tmp", cache_file)
+			except OSError:
+				pass
+	_COMPILED_RULE_SETS[key] = compiled
+	return compiled
+
+
+PEM_PRIVATE_KEY = re.compile(rb'-----BEGIN ((?:RSA |DSA |EC |OPENSSH |ENCRYPTED )?PRIVATE KEY)-----')
+# PKCS#12 keyBag and pkcs8ShroudedKeyBag object identifiers
+PKCS12_KEY_BAGS = (bytes.fromhex("060b2a864886f70d010c0a0101"), bytes.fromhex("060b2a864886f70d010c0a0102"))
+CERT_PASSWORDS = ["", "password", "mimikatz", "1234", "abcd", "secret", "123456", "pfx", "cert", "certificate", "changeit"]
+
+
+def _der_children(data: bytes, start: int, end: int) -> list:
+	'''Return (tag, value start, value end) of the DER elements between start and end, or [] if malformed'''
+	children = []
+	while start < end:
+		if start + 2 > end:
+			return []
+		tag = data[start]
+		length = data[start + 1]
+		start += 2
+		if length & 0x80:
+			count = length & 0x7f
+			if not count or count > 4 or start + count > end:
+				return []
+			length = int.from_bytes(data[start:start + count], "big")
+			start += count
+		if start + length > end:
+			return []
+		children.append((tag, start, start + length))
+		start += length
+	return children
+
+
+def _pkcs12_key(data: bytes, passwords: list) -> str:
+	'''Describe the private key of a PKCS#12 file, opening it with the given passwords when possible'''
+	if pkcs12 is not None:
+		for password in passwords:
+			try:
+				key = pkcs12.load_key_and_certificates(data, password.encode() if password else None)[0]
+			except Exception:
+				continue
+			return f"PKCS#12 PRIVATE KEY (password: '{password}')" if key is not None else ""
+	# Key bags sit outside the encrypted certificate bags in most PKCS#12 files
+	if any(oid in data for oid in PKCS12_KEY_BAGS):
+		return "PKCS#12 PRIVATE KEY (encrypted)"
+	return ""
+
+
+def find_private_key(data: bytes, passwords: list = CERT_PASSWORDS) -> str:
+	'''Return a description of the private key in a PEM, DER or PKCS#12 file, or an empty string'''
+	found = PEM_PRIVATE_KEY.search(data)
+	if found:
+		return found.group(1).decode()
+	outer = _der_children(data, 0, len(data))
+	if len(outer) != 1 or outer[0][0] != 0x30:
+		return ""
+	fields = _der_children(data, outer[0][1], outer[0][2])
+	tags = [tag for tag, _, _ in fields]
+	if len(tags) >= 2 and tags[0] == 0x02:
+		version = int.from_bytes(data[fields[0][1]:fields[0][2]], "big")
+		if version == 3 and tags[1] == 0x30:
+			return _pkcs12_key(data, passwords)
+		if version in (0, 1) and tags[1:3] == [0x30, 0x04]:
+			return "PKCS#8 PRIVATE KEY"
+		if version == 1 and tags[1] == 0x04:
+			return "EC PRIVATE KEY"
+		# PKCS#1 RSA and OpenSSL DSA keys are a version and a run of integers
+		if version == 0 and tags in ([0x02] * 9, [0x02] * 6):
+			return "RSA PRIVATE KEY" if len(tags) == 9 else "DSA PRIVATE KEY"
+	if tags == [0x30, 0x04]:
+		algorithm = _der_children(data, fields[0][1], fields[0][2])
+		if algorithm and algorithm[0][0] == 0x06:
+			return "ENCRYPTED PRIVATE KEY"
+	return ""
+
+
+# Zip based archives, Office and OpenDocument files and packages whose members are inspected
+ZIP_EXTENSIONS = (".zip", ".jar", ".war", ".ear", ".nupkg", ".vsix", ".whl", ".apk", ".docx", ".docm", ".dotx", ".xlsx", ".xlsm", ".pptx", ".pptm", ".odt", ".ods", ".odp")
+ZIP_END = b"PK\x05\x06"
+ZIP64_END = b"PK\x06\x06"
+ZIP64_LOCATOR = b"PK\x06\x07"
+ZIP_ENTRY = b"PK\x01\x02"
+ZIP_LOCAL = b"PK\x03\x04"
+# The end record is 22 bytes followed by a comment of up to 64KB
+ZIP_TAIL = 22 + 65535
+ZIP_MAX_DIRECTORY = 16 * 1024 * 1024
+# Stored and deflated members, which is nearly all of them
+ZIP_METHODS = (0, 8)
+# Text bearing parts of zipped XML documents, scanned as text instead of the whole package
+WORD_PARTS = r'word/(?:document|header\d*|footer\d*|comments|footnotes|endnotes)\.xml'
+EXCEL_PARTS = r'xl/(?:sharedStrings|worksheets/sheet\d+|comments\d*)\.xml'
+POWERPOINT_PARTS = r'ppt/(?:slides/slide\d+|notesSlides/notesSlide\d+|comments/comment\d+)\.xml'
+DOCUMENT_PARTS = {
+	".docx": WORD_PARTS,
+	".docm": WORD_PARTS,
+	".dotx": WORD_PARTS,
+	".xlsx": EXCEL_PARTS,
+	".xlsm": EXCEL_PARTS,
+	".pptx": POWERPOINT_PARTS,
+	".pptm": POWERPOINT_PARTS,
+	".odt": r'content\.xml',
+	".ods": r'content\.xml',
+	".odp": r'content\.xml'
+}
+
+
+class ZipMember:
+	'''Central directory entry of a zip archive'''
+
+	__slots__ = ("name", "method", "flags", "compressed", "size", "offset")
+
+	def __init__(self, name: str, method: int, flags: int, compressed: int, size: int, offset: int) -> None:
+		'''Initialize an entry'''
+		self.name = name
+		self.method = method
+		self.flags = flags
+		self.compressed = compressed
+		self.size = size
+		self.offset = offset
+
+	@property
+	def directory(self) -> bool:
+		'''Return True for folder entries'''
+		return self.name.endswith("/")
+
+	@property
+	def readable(self) -> bool:
+		'''Return True if the member is neither encrypted nor compressed with an unsupported method'''
+		return not self.flags & 1 and self.method in ZIP_METHODS
+
+
+class ZipArchive:
+	'''Zip archive read through ranged reads, fetching the central directory at its end and then only the members asked for'''
+
+	def __init__(self, read, size: int) -> None:
+		'''Initialize around read(offset, length), which yields the chunks of a byte range'''
+		self.read = read
+		self.size = size
+
+	def members(self) -> list:
+		'''Return the entries of the central directory'''
+		start = max(0, self.size - ZIP_TAIL)
+		tail = self._fetch(start, self.size - start)
+		end = tail.rfind(ZIP_END)
+		if end < 0 or end + 22 > len(tail):
+			raise ValueError("no end of central directory record")
+		count, length, offset = struct.unpack_from("<10xHLL", tail, end)
+		if count == 0xffff or 0xffffffff in (length, offset):
+			locator = end - 20
+			if locator < 0 or tail[locator:locator + 4] != ZIP64_LOCATOR:
+				raise ValueError("no zip64 end of central directory locator")
+			record = self._fetch(struct.unpack_from("<8xQ", tail, locator)[0], 56)
+			if record[:4] != ZIP64_END:
+				raise ValueError("no zip64 end of central directory record")
+			count, length, offset = struct.unpack_from("<32xQQQ", record)
+		if length > ZIP_MAX_DIRECTORY or offset + length > self.size:
+			raise ValueError("central directory out of bounds")
+		# Small archives have their directory in the tail already
+		directory = tail[offset - start:offset - start + length] if offset >= start else self._fetch(offset, length)
+		members = []
+		pos = 0
+		while len(members) < count and pos + 46 <= len(directory):
+			if directory[pos:pos + 4] != ZIP_ENTRY:
+				raise ValueError("bad central directory entry")
+			flags, method, compressed, size, name_length, extra_length, comment_length, local = struct.unpack_from("<8xHH8xLLHHH8xL", directory, pos)
+			name = directory[pos + 46:pos + 46 + name_length].decode("utf-8" if flags & 0x800 else "cp437", "replace")
+			if 0xffffffff in (compressed, size, local):
+				extra = directory[pos + 46 + name_length:pos + 46 + name_length + extra_length]
+				compressed, size, local = self._zip64_extra(extra, compressed, size, local)
+			members.append(ZipMember(name, method, flags, compressed, size, local))
+			pos += 46 + name_length + extra_length + comment_length
+		return members
+
+	def extract(self, member: ZipMember, limit: int):
+		'''Yield the decompressed chunks of a stored or deflated member, stopping after limit bytes'''
+		if limit <= 0:
+			return
+		header = self._fetch(member.offset, 30)
+		if header[:4] != ZIP_LOCAL:
+			raise ValueError(f"bad local header for {member.name}")
+		name_length, extra_length = struct.unpack_from("<26xHH", header)
+		inflater = zlib.decompressobj(-15) if member.method == 8 else None
+		for chunk in self.read(member.offset + 30 + name_length + extra_length, member.compressed):
+			# Inflating at most limit bytes per chunk keeps zip bombs from filling memory
+			chunk = inflater.decompress(chunk, limit) if inflater else chunk[:limit]
+			if chunk:
+				limit -= len(chunk)
+				yield chunk
+			if not limit:
+				return
+
+	def _fetch(self, offset: int, length: int) -> bytes:
+		'''Return a byte range of the archive, raising if it is cut short'''
+		data = b"".join(self.read(offset, length))
+		if len(data) < length:
+			raise ValueError("truncated archive")
+		return data
+
+	def _zip64_extra(self, extra: bytes, compressed: int, size: int, local: int) -> tuple:
+		'''Return the sizes and offset of an entry, taking those too large for 32 bits from its zip64 extra field'''
+		pos = 0
+		while pos + 4 <= len(extra):
+			tag, length = struct.unpack_from("<HH", extra, pos)
+			if tag == 1:
+				values = iter(struct.unpack_from(f"<{length // 8}Q", extra, pos + 4))
+				size = next(values) if size == 0xffffffff else size
+				compressed = next(values) if compressed == 0xffffffff else compressed
+				local = next(values) if local == 0xffffffff else local
+				break
+			pos += 4 + length
+		return compressed, size, local
+
+
+FP_FOLDERS = [
+	r"/puppet/share/doc",
+	r"/lib/ruby",
+	r"/lib/site-packages",
+	r"/usr/share/doc",
+	r"node_modules",
+	r"vendor/bundle",
+	r"vendor/cache",
+	r"/doc/openssl",
+	r"Anaconda3/Lib/test",
+	r"WindowsPowerShell/Modules",
+	r"Python[\d\x2e]{0,4}/Lib",
+	r"Reference Assemblies/Microsoft/Framework/\.NETFramework",
+	r"dotnet/sdk",
+	r"dotnet/shared",
+	r"Modules/Microsoft\.PowerShell\.Security",
+	r"Windows/assembly",
+	r"/winsxs",
+	r"/syswow64",
+	r"/system32",
+	r"/systemapps",
+	r"/windows/servicing",
+	r"/servicing",
+	r"/Microsoft\.NET/Framework",
+	r"/windows/immersivecontrolpanel",
+	r"/windows/diagnostics",
+	r"/windows/debug",
+	r"/locale",
+	r"/chocolatey/helpers",
+	r"/sources/sxs",
+	r"/localization",
+	r"/AppData/Local/Microsoft",
+	r"/AppData/Roaming/Microsoft/Windows",
+	r"/AppData/Roaming/Microsoft/Teams",
+	r"/wsuscontent",
+	r"/Application Data/Microsoft/CLR Security Config",
+	r"/servicing/LCU",
+	r"Windows Kits/10",
+	r"Git/mingw64",
+	r"Git/usr/lib",
+	r"ProgramData/Microsoft/NetFramework/BreadcrumbStore",
+	r"\.MSSQLSERVER/MSSQL/Binn/Templates"
+]
+
+
+class FolderFilter:
+	'''False positive folder filter applied in a single regex pass'''
+
+	def __init__(self, patterns: list, memo_size: int = 65536) -> None:
+		'''Compile the folder patterns into one case-insensitive regex'''
+		self.regex = _alternation(patterns)
+		self.width = _max_width(self.regex)
+		self.memo_size = memo_size
+		# Folders that already passed, so their subfolders only need the new segment tested,
+		# shared by the crawl workers of every host
+		self._accepted = {}
+		self._lock = threading.Lock()
+
+	def accepts(self, folder: str) -> bool:
+		'''Return True if folder is not known for false positives'''
+		start = 0
+		parent = folder.rpartition("/")[0]
+		with self._lock:
+			known = parent in self._accepted
+		if self.width is not None and known:
+			# A match inside the accepted parent is impossible, so only look at
+			# matches that reach into the new path segment
+			start = max(0, len(parent) - self.width + 1)
+		if self.regex.search(folder, start):
+			return False
+		with self._lock:
+			if len(self._accepted) >= self.memo_size:
+				self._accepted.pop(next(iter(self._accepted), None), None)
+			self._accepted[folder] = True
+		return True
+
+
+FOLDER_FILTER = FolderFilter(FP_FOLDERS)
+
+# Folders crawled before everything else so the best findings surface early
+PRIORITY_FOLDERS = [
+	r"/it(/|$)",
+	r"/backups?(/|$)",
+	r"/scripts?(/|$)",
+	r"/deploy",
+	r"/\.ssh(/|$)",
+	r"/sysvol(/|$)",
+	r"/admin",
+	r"/infra",
+	r"/install",
+	r"/sccm",
+	r"/keys?(/|$)",
+	r"passw",
+	r"secret",
+	r"cred"
+]
+
+
+class CrawlBudget:
+	'''Wall clock, byte and file limits for one host or share, 0 meaning no limit'''
+
+	def __init__(self, seconds: int = 0, max_bytes: int = 0, max_files: int = 0) -> None:
+		'''Initialize an unstarted budget'''
+		self.seconds = seconds
+		self.max_bytes = max_bytes
+		self.max_files = max_files
+		self.bytes = 0
+		self.files = 0
+		self.started = None
+		self._lock = threading.Lock()
+
+	def start(self) -> None:
+		'''Start the wall clock if it is not running yet'''
+		if self.started is None:
+			self.started = time.monotonic()
+
+	def spend(self, nbytes: int = 0, files: int = 0) -> None:
+		'''Count downloaded bytes and examined files against the budget'''
+		with self._lock:
+			self.bytes += nbytes
+			self.files += files
+
+	def exceeded(self, count_files: bool = True) -> str:
+		'''Return the name of the spent limit, or an empty string'''
+		if self.seconds and self.started is not None and time.monotonic() - self.started >= self.seconds:
+			return "time"
+		if self.max_bytes and self.bytes >= self.max_bytes:
+			return "byte"
+		if count_files and self.max_files and self.files >= self.max_files:
+			return "file"
+		return ""
+
+
+class DedupeCache:
+	'''Content fingerprints and findings of scanned files, shared by every host of a run'''
+
+	def __init__(self, block_size: int = 4096, trust_precheck: bool = False, max_entries: int = 100000) -> None:
+		'''Initialize an empty cache'''
+		self.block_size = block_size
+		self.trust_precheck = trust_precheck
+		self.max_entries = max_entries
+		# (size, head and tail digest) -> [(content sha256, origin, relay rules run, hits)]
+		self._entries = {}
+		self._lock = threading.Lock()
+
+	def fingerprint(self, size: int, sample: bytes) -> tuple:
+		'''Return the cheap pre-check key of a file from its size and first and last blocks'''
+		return size, hashlib.sha1(sample).digest()
+
+	def lookup(self, fingerprint: tuple, relay_configs: list) -> list:
+		'''Return the entries of a fingerprint whose scan ran at least the given relay rules'''
+		rules = set(relay_configs)
+		with self._lock:
+			return [entry for entry in self._entries.get(fingerprint, ()) if rules <= entry[2]]
+
+	def add(self, fingerprint: tuple, sha256: str, origin: str, relay_configs: list, hits: list) -> None:
+		'''Remember the findings of a fully read file, dropping the oldest fingerprint when full'''
+		with self._lock:
+			if fingerprint not in self._entries and len(self._entries) >= self.max_entries:
+				self._entries.pop(next(iter(self._entries)))
+			self._entries.setdefault(fingerprint, []).append((sha256, origin, frozenset(relay_configs), tuple(hits)))
+
+	def reuse(self, entry: tuple, relay_configs: list) -> list:
+		'''Return the cached hits of an entry for the given relay rules'''
+		rules = set(relay_configs)
+		return [(rr, m) for rr, m in entry[3] if rr["rule"] in rules]
+
+
+class ListingEntry:
+	'''Directory entry kept in the listing cache, with the SharedFile accessors the crawler uses'''
+
+	__slots__ = ("name", "size", "mtime", "directory")
+
+	def __init__(self, name: str, size: int, mtime: int, directory: bool) -> None:
+		'''Initialize an entry'''
+		self.name = name
+		self.size = size
+		self.mtime = mtime
+		self.directory = directory
+
+	def get_longname(self) -> str:
+		'''Return the entry name'''
+		return self.name
+
+	def get_filesize(self) -> int:
+		'''Return the file size in bytes'''
+		return self.size
+
+	def get_mtime_epoch(self) -> int:
+		'''Return the last write time as a Unix timestamp'''
+		return self.mtime
+
+	def is_directory(self) -> bool:
+		'''Return True for folders'''
+		return self.directory
+
+
+class ListingCache:
+	'''Directory listings shared by every host of a run, least recently used evicted past max_bytes'''
+
+	def __init__(self, max_bytes: int = 64 * 1024 * 1024, store=None, ttl: int = 3600) -> None:
+		'''Initialize an empty cache, optionally backed by a ListingStore'''
+		self.max_bytes = max_bytes
+		self.store = store
+		self.ttl = ttl
+		self._entries = OrderedDict()
+		self._bytes = 0
+		# Listings being fetched, so threads asking for the same folder wait for one fetch
+		self._pending = {}
+		self._lock = threading.Lock()
+
+	def get(self, key: str, loader) -> list:
+		'''Return the listing of key, calling loader once for every thread that asks for it at the same time'''
+		while True:
+			with self._lock:
+				if key in self._entries:
+					self._entries.move_to_end(key)
+					return self._entries[key][0]
+				event = self._pending.get(key)
+				if event is None:
+					self._pending[key] = threading.Event()
+					break
+			# A failed fetch leaves nothing cached and the next waiter tries again
+			event.wait()
+		try:
+			listing = self.store.load(key, self.ttl) if self.store else None
+			if listing is None:
+				listing = loader()
+				if self.store:
+					self.store.save(key, listing)
+			self._add(key, listing)
+		finally:
+			with self._lock:
+				self._pending.pop(key).set()
+		return listing
+
+	def _add(self, key: str, listing: list) -> None:
+		'''Cache a listing, evicting the least recently used ones to stay under max_bytes'''
+		size = len(key) + sum(80 + 2 * len(entry.name) for entry in listing)
+		if size > self.max_bytes:
+			return
+		with self._lock:
+			self._entries[key] = (listing, size)
+			self._bytes += size
+			while self._bytes > self.max_bytes:
+				self._bytes -= self._entries.popitem(last=False)[1][1]
+
+
+class SQLiteStore:
+	'''SQLite database shared by all host threads with batched commits'''
+
+	def __init__(self, path: str, commit_every: int = 500) -> None:
+		'''Open or create the database'''
+		self.path = path
+		self.commit_every = commit_every
+		self._lock = threading.Lock()
+		self._writes = 0
+		self._db = sqlite3.connect(path, check_same_thread=False)
+		self._db.execute("PRAGMA journal_mode=WAL")
+		self._db.execute("PRAGMA synchronous=NORMAL")
+
+	def _write(self, sql: str, params: tuple) -> None:
+		'''Run a write, committing in batches'''
+		with self._lock:
+			self._db.execute(sql, params)
+			self._writes += 1
+			if self._writes >= self.commit_every:
+				self._db.commit()
+				self._writes = 0
+
+	def _read(self, sql: str, params: tuple) -> list:
+		'''Return the rows of a query'''
+		with self._lock:
+			return self._db.execute(sql, params).fetchall()
+
+	def flush(self) -> None:
+		'''Commit pending writes'''
+		with self._lock:
+			self._db.commit()
+			self._writes = 0
+
+
+class CrawlState(SQLiteStore):
+	'''SQLite record of finished folders and files, used to resume interrupted crawls'''
+
+	def __init__(self, path: str, commit_every: int = 500) -> None:
+		'''Open or create the state database'''
+		super().__init__(path, commit_every)
+		# Folders whose whole subtree finished
+		self._db.execute("CREATE TABLE IF NOT EXISTS folders (host TEXT, share TEXT, path TEXT, PRIMARY KEY (host, share, path))")
+		# Finished files of folders that are not finished yet
+		self._db.execute("CREATE TABLE IF NOT EXISTS files (host TEXT, share TEXT, folder TEXT, name TEXT, PRIMARY KEY (host, share, folder, name))")
+		self._db.commit()
+
+	def reset(self, host: str) -> None:
+		'''Forget the previous crawl of a host'''
+		self._write("DELETE FROM folders WHERE host = ?", (host,))
+		self._write("DELETE FROM files WHERE host = ?", (host,))
+
+	def folder_done(self, host: str, share: str, path: str) -> bool:
+		'''Return True if the whole subtree of a folder was crawled'''
+		return bool(self._read("SELECT 1 FROM folders WHERE host = ? AND share = ? AND path = ?", (host, share, path)))
+
+	def files_done(self, host: str, share: str, folder: str) -> set:
+		'''Return the names of the finished files of a folder'''
+		return {row[0] for row in self._read("SELECT name FROM files WHERE host = ? AND share = ? AND folder = ?", (host, share, folder))}
+
+	def finish_file(self, host: str, share: str, path: str) -> None:
+		'''Record a file as examined and scanned'''
+		folder, _, name = path.rpartition("/")
+		self._write("INSERT OR IGNORE INTO files VALUES (?, ?, ?, ?)", (host, share, folder + "/", name))
+
+	def finish_folder(self, host: str, share: str, path: str) -> None:
+		'''Record a finished subtree, replacing the records below it'''
+		# Every descendant path sorts between "/a/" and "/a0"
+		upper = path[:-1] + "0"
+		self._write("DELETE FROM files WHERE host = ? AND share = ? AND folder >= ? AND folder < ?", (host, share, path, upper))
+		self._write("DELETE FROM folders WHERE host = ? AND share = ? AND path > ? AND path < ?", (host, share, path, upper))
+		self._write("INSERT OR IGNORE INTO folders VALUES (?, ?, ?)", (host, share, path))
+
+
+# Bump when the findings stored for a file change so older indexes are rebuilt
+INDEX_VERSION = 3
+
+
+class ScanIndex(SQLiteStore):
+	'''SQLite index of file sizes, write times and findings from earlier runs, used for incremental re-scans'''
+
+	def __init__(self, path: str, commit_every: int = 500) -> None:
+		'''Open or create the index database'''
+		super().__init__(path, commit_every)
+		self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+		# Findings are a JSON list of [triage, rule, match, partial], scanned is 0 while a content scan is owed
+		self._db.execute("CREATE TABLE IF NOT EXISTS files (host TEXT, share TEXT, folder TEXT, name TEXT, size INTEGER, mtime INTEGER, findings TEXT, scanned INTEGER, PRIMARY KEY (host, share, folder, name))")
+		self._db.execute("CREATE TABLE IF NOT EXISTS folders (host TEXT, share TEXT, path TEXT, signature TEXT, PRIMARY KEY (host, share, path))")
+		self._db.commit()
+
+	def check_rules(self, digest: str) -> None:
+		'''Drop the index if it was built with different rules or by an older version'''
+		digest = f"{INDEX_VERSION}|{digest}"
+		with self._lock:
+			row = self._db.execute("SELECT value FROM meta WHERE key = 'rules'").fetchone()
+			if row and row[0] == digest:
+				return
+			self._db.execute("DELETE FROM files")
+			self._db.execute("DELETE FROM folders")
+			self._db.execute("INSERT OR REPLACE INTO meta VALUES ('rules', ?)", (digest,))
+			self._db.commit()
+
+	def folder_files(self, host: str, share: str, folder: str) -> dict:
+		'''Return name -> (size, mtime, findings, scanned) for the indexed files of a folder'''
+		rows = self._read("SELECT name, size, mtime, findings, scanned FROM files WHERE host = ? AND share = ? AND folder = ?", (host, share, folder))
+		return {row[0]: (row[1], row[2], json.loads(row[3]), bool(row[4])) for row in rows}
+
+	def record_file(self, host: str, share: str, path: str, size: int, mtime: int, findings: list, scanned: bool) -> None:
+		'''Store the fingerprint and name rule findings of a file'''
+		folder, _, name = path.rpartition("/")
+		self._write("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (host, share, folder + "/", name, size, mtime, json.dumps(findings), int(scanned)))
+
+	def record_scan(self, host: str, share: str, path: str, findings: list) -> None:
+		'''Add content findings to a file and mark its content scan done'''
+		folder, _, name = path.rpartition("/")
+		with self._lock:
+			row = self._db.execute("SELECT findings FROM files WHERE host = ? AND share = ? AND folder = ? AND name = ?", (host, share, folder + "/", name)).fetchone()
+		if row is not None:
+			self._write("UPDATE files SET findings = ?, scanned = 1 WHERE host = ? AND share = ? AND folder = ? AND name = ?", (json.dumps(json.loads(row[0]) + findings), host, share, folder + "/", name))
+
+	def prune(self, host: str, share: str, folder: str, names: set) -> None:
+		'''Forget indexed files of a folder that no longer exist'''
+		for name in set(self.folder_files(host, share, folder)) - names:
+			self._write("DELETE FROM files WHERE host = ? AND share = ? AND folder = ? AND name = ?", (host, share, folder, name))
+
+	def signature(self, host: str, share: str, folder: str) -> str:
+		'''Return the listing signature stored for a folder'''
+		rows = self._read("SELECT signature FROM folders WHERE host = ? AND share = ? AND path = ?", (host, share, folder))
+		return rows[0][0] if rows else ""
+
+	def set_signature(self, host: str, share: str, folder: str, signature: str) -> None:
+		'''Store the listing signature of a folder whose files are all indexed'''
+		self._write("INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)", (host, share, folder, signature))
+
+
+class ListingStore(SQLiteStore):
+	'''SQLite copy of the listing cache so reruns can reuse recent listings'''
+
+	def __init__(self, path: str, commit_every: int = 500) -> None:
+		'''Open or create the listing database'''
+		super().__init__(path, commit_every)
+		# Entries are a JSON list of [name, size, mtime, directory]
+		self._db.execute("CREATE TABLE IF NOT EXISTS listings (key TEXT PRIMARY KEY, listed REAL, entries TEXT)")
+		self._db.commit()
+
+	def load(self, key: str, ttl: int = 0) -> list:
+		'''Return a stored listing younger than ttl seconds, or None'''
+		rows = self._read("SELECT listed, entries FROM listings WHERE key = ?", (key,))
+		if not rows or (ttl and time.time() - rows[0][0] > ttl):
+			return None
+		return [ListingEntry(*entry) for entry in json.loads(rows[0][1])]
+
+	def save(self, key: str, listing: list) -> None:
+		'''Store a listing'''
+		entries = [[entry.name, entry.size, entry.mtime, entry.directory] for entry in listing]
+		self._write("INSERT OR REPLACE INTO listings VALUES (?, ?, ?)", (key, time.time(), json.dumps(entries)))
+
+
+FINDING_FIELDS = ("timestamp", "triage", "rule", "host", "share", "path", "match", "size", "mtime", "partial")
+
+
+class FindingSink:
+	'''Structured destination for findings, shared by all host threads'''
+
+	def write(self, finding: dict) -> None:
+		'''Record one finding with the FINDING_FIELDS keys'''
+		raise NotImplementedError
+
+	def flush(self) -> None:
+		'''Hand buffered findings to the operating system'''
+
+
+class JSONLSink(FindingSink):
+	'''JSON lines file of findings, written in batches'''
+
+	def __init__(self, path: str, buffer_lines: int = 500) -> None:
+		'''Open the file for appending'''
+		self.path = path
+		self.buffer_lines = buffer_lines
+		self._lines = []
+		self._lock = threading.Lock()
+		self._file = open(path, "a", encoding="utf-8")
+
+	def write(self, finding: dict) -> None:
+		'''Buffer a finding, writing the batch once it is full'''
+		line = json.dumps(finding, ensure_ascii=False)
+		with self._lock:
+			self._lines.append(line)
+			if len(self._lines) >= self.buffer_lines:
+				self._drain()
+
+	def flush(self) -> None:
+		'''Write buffered findings'''
+		with self._lock:
+			self._drain()
+
+	def _drain(self) -> None:
+		'''Write and clear the buffer, without syncing it to disk'''
+		if self._lines:
+			self._file.write("\n".join(self._lines) + "\n")
+			self._lines.clear()
+		self._file.flush()
+
+
+class SQLiteSink(SQLiteStore, FindingSink):
+	'''SQLite table of findings, committed in batches'''
+
+	def __init__(self, path: str, commit_every: int = 500) -> None:
+		'''Open or create the findings database'''
+		super().__init__(path, commit_every)
+		self._db.execute("CREATE TABLE IF NOT EXISTS findings (timestamp TEXT, triage TEXT, rule TEXT, host TEXT, share TEXT, path TEXT, match TEXT, size INTEGER, mtime INTEGER, partial INTEGER)")
+		self._db.commit()
+
+	def write(self, finding: dict) -> None:
+		'''Insert a finding'''
+		self._write("INSERT INTO findings VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", tuple(finding[field] for field in FINDING_FIELDS))
+
+
+class FindingWriter:
+	'''Background thread writing queued findings to the console and the structured outputs in batches'''
+
+	def __init__(self, sinks: list = None, console_triage: str = "Green", batch_size: int = 500) -> None:
+		'''Initialize a writer whose thread starts with the first finding'''
+		self.sinks = sinks or []
+		# Findings less severe than console_triage only go to the structured outputs
+		self.console_levels = set(TRIAGE_ORDER[:TRIAGE_ORDER.index(console_triage) + 1])
+		self.batch_size = batch_size
+		self._queue = queue.Queue()
+		self._thread = None
+		self._start_lock = threading.Lock()
+
+	def emit(self, logger, finding: tuple) -> None:
+		'''Queue a finding with the FINDING_FIELDS values, never waiting on output'''
+		if self._thread is None:
+			with self._start_lock:
+				if self._thread is None:
+					self._thread = threading.Thread(target=self._run, daemon=True)
+					self._thread.start()
+		self._queue.put((logger, finding))
+
+	def flush(self) -> None:
+		'''Wait for queued findings to be written and flush the structured outputs'''
+		self._queue.join()
+		for sink in self.sinks:
+			sink.flush()
+
+	def _run(self) -> None:
+		'''Write findings in batches of whatever is queued'''
+		while True:
+			batch = [self._queue.get()]
+			while len(batch) < self.batch_size:
+				try:
+					batch.append(self._queue.get_nowait())
+				except queue.Empty:
+					break
+			try:
+				self._write(batch)
+			except Exception as e:
+				batch[0][0].debug(f"Error writing findings: {str(e)}")
+			finally:
+				for _ in batch:
+					self._queue.task_done()
+
+	def _write(self, batch: list) -> None:
+		'''Log and store a batch of findings'''
+		for logger, (now, triage, rule_name, host, share_name, full_path, match, size, mtime, partial) in batch:
+			if triage in self.console_levels:
+				# Content found in a sampled file, the rest of it was never read
+				sampled = " [partial]" if partial else ""
+				logger.info(f'<CREDHUNT>{now.strftime("%Y-%m-%d %H:%M:%S")}|[{triage}]|{rule_name}|//{host}/{share_name}{full_path}|{match}{sampled}</CREDHUNT>')
+			if self.sinks:
+				if isinstance(match, bytes):
+					match = match.decode("utf-8", "replace")
+				values = (now.isoformat(timespec="seconds"), triage, rule_name, host, share_name, full_path, str(match), size, mtime, bool(partial))
+				finding = dict(zip(FINDING_FIELDS, values))
+				for sink in self.sinks:
+					sink.write(finding)
+
+
+# Server answers meaning the session is gone, any other SessionError is about the request
+SESSION_LOST_ERRORS = (
+	STATUS_USER_SESSION_DELETED,
+	STATUS_NETWORK_SESSION_EXPIRED,
+	STATUS_NETWORK_NAME_DELETED,
+	STATUS_CONNECTION_DISCONNECTED,
+	STATUS_CONNECTION_RESET
+)
+
+
+class PooledConnection:
+	'''Authenticated SMB connection of a host's pool, with the trees it has connected'''
+
+	__slots__ = ("conn", "trees", "owned")
+
+	def __init__(self, conn, owned: bool = True) -> None:
+		'''Initialize around a logged in connection'''
+		self.conn = conn
+		self.trees = {}
+		# The CME connection is left for CME to close
+		self.owned = owned
+
+	def tree(self, share: str) -> int:
+		'''Return the tree id of a share, connecting to it on first use'''
+		tid = self.trees.get(share)
+		if tid is None:
+			tid = self.trees[share] = self.conn.connectTree(share)
+		return tid
+
+	def reset(self, conn) -> None:
+		'''Swap in a new connection, whose trees still have to be connected'''
+		self.conn = conn
+		self.trees = {}
+		self.owned = True
+
+	def close(self) -> None:
+		'''Close the connection if the pool opened it'''
+		try:
+			if self.owned:
+				self.conn.close()
+		except Exception:
+			pass
+
+
+class ConnectionPool:
+	'''SMB sessions of one host shared by its crawl workers, broken ones replaced with capped exponential backoff and jitter'''
+
+	def __init__(self, smb, logger, size: int = 1, attempts: int = 5, base_delay: float = 1.0, max_delay: float = 30.0, retries: int = 3) -> None:
+		'''Initialize around the CME connection, further connections are opened as workers need them'''
+		self.smb = smb
+		self.host = smb.conn.getRemoteHost()
+		self.logger = logger
+		self.size = max(1, size)
+		self.attempts = attempts
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		# Times one operation is retried on a fresh session before it fails
+		self.retries = retries
+		self.opened = 0
+		self.reconnects = 0
+		self.failed_reconnects = 0
+		# Set once a member ran out of reconnect attempts, so the other workers stop instead of backing off too
+		self.down = False
+		self._idle = deque([PooledConnection(smb.conn, owned=False)])
+		self._members = 1
+		self._cond = threading.Condition()
+		# Member borrowed by the current thread, so nested borrows reuse it
+		self._local = threading.local()
+
+	def new_connection(self):
+		'''Return a new SMB connection authenticated with the credentials of the CME connection'''
+		smb = self.smb
+		conn = SMBConnection(smb.conn.getRemoteName(), self.host, None, getattr(smb.args, "port", 445), timeout=getattr(smb.args, "smb_timeout", 60))
+		if getattr(smb, "kerberos", False):
+			conn.kerberosLogin(smb.username, smb.password, smb.domain, smb.lmhash, smb.nthash, smb.aesKey, smb.kdcHost)
+		else:
+			conn.login(smb.username, smb.password, smb.domain, smb.lmhash, smb.nthash)
+		with self._cond:
+			self.opened += 1
+		return conn
+
+	def acquire(self) -> PooledConnection:
+		'''Borrow an idle member, opening a new one while the pool is below its size'''
+		member = getattr(self._local, "member", None)
+		if member is not None:
+			self._local.depth += 1
+			return member
+		while True:
+			with self._cond:
+				while not self._idle and self._members >= self.size and not self.down:
+					self._cond.wait()
+				if self.down:
+					raise ConnectionError(f"gave up on {self.host}")
+				if self._idle:
+					member = self._idle.popleft()
+				else:
+					self._members += 1
+			if member is None:
+				try:
+					member = PooledConnection(self.new_connection())
+				except Exception as e:
+					with self._cond:
+						self._members -= 1
+						if not self._members:
+							raise
+						# The server may refuse more sessions, make do with the ones it accepted
+						self.size = self._members
+					self.logger.debug(f"Connection pool of {self.host} stays at {self.size} sessions: {str(e)}")
+					continue
+			self._local.member = member
+			self._local.depth = 1
+			return member
+
+	def release(self, member: PooledConnection) -> None:
+		'''Give a borrowed member back to the pool'''
+		self._local.depth -= 1
+		if self._local.depth:
+			return
+		self._local.member = None
+		with self._cond:
+			self._idle.append(member)
+			self._cond.notify()
+
+	def close(self) -> None:
+		'''Close the idle members the pool opened'''
+		with self._cond:
+			while self._idle:
+				self._idle.popleft().close()
+			self._members = 0
+
+	def lost(self, error: Exception) -> bool:
+		'''Return True if an error means the session is gone rather than one request being refused'''
+		# SMBConnection wraps server errors in its own SessionError, the SMB1 and SMB3 layers raise theirs
+		if isinstance(error, SessionError):
+			return error.getErrorCode() in SESSION_LOST_ERRORS
+		if isinstance(error, (SMBSessionError, SMB3SessionError)):
+			return error.get_error_code() in SESSION_LOST_ERRORS
+		# Otherwise only a broken transport means the session is gone
+		return isinstance(error, (NetBIOSError, NetBIOSTimeout, OSError, EOFError))
+
+	def reconnect(self, member: PooledConnection) -> bool:
+		'''Replace the connection of a broken member, backing off between attempts, and return False once the host looks down'''
+		# Only the borrowing worker waits, the other members carry on
+		member.close()
+		for attempt in range(self.attempts):
+			if self.down:
+				return False
+			delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+			time.sleep(delay / 2 + random.uniform(0, delay / 2))
+			try:
+				member.reset(self.new_connection())
+			except Exception as e:
+				with self._cond:
+					self.failed_reconnects += 1
+				self.logger.debug(f"Reconnect {attempt + 1}/{self.attempts} to {self.host} failed: {str(e)}")
+				continue
+			with self._cond:
+				self.reconnects += 1
+			return True
+		with self._cond:
+			self.down = True
+			self._cond.notify_all()
+		self.logger.info(f"Giving up on {self.host} after {self.attempts} failed reconnects")
+		return False
+
 
 class CredentialCrawler:
 
-	def __init__(self, smb, logger) -> None:
+	def __init__(self, smb, logger, options: dict = None) -> None:
 		'''Initialize password spider'''
+		options = options or {}
 		self.smb = smb
 		self.host = self.smb.conn.getRemoteHost()
-		self.max_connection_attempts = 5
 		self.logger = logger
-		self.max_size = 10 * 1024 * 1024
-		self.max_connection_attempts = 5
-		# Snaffler rules modified for Python
-		self.rules = {
-			'FilePath': [
-				{
-					'rule': 'KeepSSHFilesByPath',
-					'target': 'FilePath',
-					'match_type': 'Contains',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'/\\.ssh/'
-					]
-				},
-				{
-					'rule': 'KeepDomainJoinCredsByPath',
-					'target': 'FilePath',
-					'match_type': 'Contains',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'control/customsettings.ini'
-					]
-				},
-				{
-					'rule': 'KeepSCCMBootVarCredsByPath',
-					'target': 'FilePath',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'reminst/smstemp/.*\\.var',
-						'sms/data/variables.dat',
-						'sms/data/policy.xml'
-					]
-				},
-				{
-					'rule': 'KeepCloudApiKeysByPath',
-					'target': 'FilePath',
-					'match_type': 'Contains',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'/\\.aws/',
-						'doctl/config.yaml'
-					]}
-			],
-			'FileName': [
-				{
-					'rule': 'KeepFtpClientConfigConfigByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'recentservers.xml',
-						'sftp-config.json'
-					]
-				},
-				{
-					'rule': 'KeepWinHashesByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'ntds.dit',
-						'system',
-						'sam',
-						'security'
-					]
-				},
-				{
-					'rule': 'KeepDbMgtConfigByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'sqlstudio.bin',
-						'.mysql_history',
-						'.psql_history',
-						'.pgpass',
-						'.dbeaver-data-sources.xml',
-						'credentials-config.json',
-						'dbvis.xml',
-						'robomongo.json'
-					]
-				},
-				{
-					'rule': 'KeepShellHistoryByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Green',
-					'wordlist': [
-						'.bash_history',
-						'.zsh_history',
-						'.sh_history',
-						'zhistory',
-						'.irb_history',
-						'consolehost_history.txt'
-					]
-				},
-				{
-					'rule': 'KeepRubyByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'database.yml',
-						'.secret_token.rb',
-						'knife.rb',
-						'carrierwave.rb',
-						'omniauth.rb'
-					]
-				},
-				{
-					'rule': 'KeepMemDumpByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'memory.dmp',
-						'hiberfil.sys',
-						'lsass.dmp',
-						'lsass.exe.dmp'
-					]
-				},
-				{
-					'rule': 'KeepRemoteAccessConfByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'mobaxterm.ini',
-						'mobaxterm backup.zip',
-						'confcons.xml'
-					]
-				},
-				{
-					'rule': 'KeepSSHKeysByFileName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'id_rsa',
-						'id_dsa',
-						'id_ecdsa',
-						'id_ed25519'
-					]
-				},
-				{
-					'rule': 'KeepConfigByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'.htpasswd'
-					]
-				},
-				{
-					'rule': 'CertContentByEnding',
-					'target': 'FileName',
-					'match_type': 'EndsWith',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'_rsa',
-						'_dsa',
-						'_ed25519',
-						'_ecdsa'
-					],
-					'relay_configs': [
-						'KeepInlinePrivateKey'
-					]
-				},
-				{
-					'rule': 'KeepShellRcFilesByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Green',
-					'wordlist': [
-						'.netrc',
-						'_netrc',
-						'.exports',
-						'.functions',
-						'.extra',
-						'.npmrc',
-						'.env',
-						'.bashrc',
-						'.profile',
-						'.zshrc'
-					]
-				},
-				{
-					'rule': 'KeepNetConfigFileByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'running-config.cfg',
-						'startup-config.cfg',
-						'running-config',
-						'startup-config'
-					]
-				},
-				{
-					'rule': 'RelayUnattendXml',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'unattend.xml',
-						'autounattend.xml'
-					],
-					'relay_configs': [
-						'KeepUnattendXmlRegexRed'
-					]
-				},
-				{
-					'rule': 'RelayNetConfigByName',
-					'target': 'FileName',
-					'match_type': 'Contains',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'cisco',
-						'router',
-						'firewall',
-						'switch'
-					],
-					'relay_configs': [
-						'KeepNetConfigCreds'
-					]
-				},
-				{
-					'rule': 'KeepDomainJoinCredsByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Yellow',
-					'wordlist': [
-						'customsettings.ini'
-					]
-				},
-				{
-					'rule': 'KeepFtpServerConfigByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'proftpdpasswd',
-						'filezilla.xml'
-					]
-				},
-				{
-					'rule': 'KeepDefenderConfigByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Yellow',
-					'wordlist': [
-						'sensorconfiguration.json',
-						'mdatp_managed.json'
-					]
-				},
-				{
-					'rule': 'KeepPasswordFilesByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'passwords.txt',
-						'pass.txt',
-						'accounts.txt',
-						'passwords.doc',
-						'pass.doc',
-						'accounts.doc',
-						'passwords.xls',
-						'pass.xls',
-						'accounts.xls',
-						'passwords.docx',
-						'pass.docx',
-						'accounts.docx',
-						'passwords.xlsx',
-						'pass.xlsx',
-						'accounts.xlsx',
-						'secrets.txt',
-						'secrets.doc',
-						'secrets.xls',
-						'secrets.docx',
-						'secrets.xlsx'
-					]
-				},
-				{
-					'rule': 'KeepNameContainsGreen',
-					'target': 'FileName',
-					'match_type': 'Contains',
-					'action': 'Snaffle',
-					'triage': 'Green',
-					'wordlist': [
-						'passw',
-						'secret',
-						'credential',
-						'thycotic',
-						'cyberark'
-					]
-				},
-				{
-					'rule': 'KeepPhpByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'localsettings.php'
-					]
-				},
-				{
-					'rule': 'KeepFfLoginsJsonRelay',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'logins.json'
-					],
-					'relay_configs': [
-						'KeepFFRegexRed'
-					]
-				},
-				{
-					'rule': 'KeepJenkinsByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'jenkins.plugins.publish_over_ssh.bapsshpublisherplugin.xml',
-						'credentials.xml'
-					]
-				},
-				{
-					'rule': 'KeepCyberArkConfigsByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'psmapp.cred',
-						'psmgw.cred',
-						'backup.key',
-						'masterreplicationuser.pass',
-						'recprv.key',
-						'replicationuser.pass',
-						'server.key',
-						'vaultemergency.pass',
-						'vaultuser.pass',
-						'vault.ini',
-						'padr.ini',
-						'paragent.ini',
-						'cacpmscanner.exe.config',
-						'pvconfiguration.xml'
-					]
-				},
-				{
-					'rule': 'KeepNixLocalHashesByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'shadow',
-						'pwd.db',
-						'passwd'
-					]
-				},
-				{
-					'rule': 'KeepPSHistoryByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'consolehost_history.txt'
-					],
-					'relay_configs': [
-						'KeepPsCredentials',
-						'KeepCmdCredentials',
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation',
-						'KeepDbConnStringPw'
-					]
-				},
-				{
-					'rule': 'KeepGitCredsByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'.git-credentials'
-					]
-				},
-				{
-					'rule': 'KeepKerberosCredentialsByName',
-					'target': 'FileName',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Yellow',
-					'wordlist': [
-						'krb5cc_.*'
-					]
-				},
-				{
-					'rule': 'KeepCloudApiKeysByName',
-					'target': 'FileName',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'.tugboat'
-					]}
-			],
-			'FileExtension': [
-				{
-					'rule': 'RelayCertByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'CheckForKeys',
-					'triage': 'Red',
-					'wordlist': [
-						'.pem',
-						'.der',
-						'.pfx',
-						'.pk12',
-						'.p12',
-						'.pkcs12'
-					]
-				},
-				{
-					'rule': 'KeepCyberArkByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'.cred',
-						'.pass'
-					]
-				},
-				{
-					'rule': 'KeepDatabaseByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Yellow',
-					'wordlist': [
-						'.mdf',
-						'.sdf',
-						'.sqldump',
-						'.bak'
-					]
-				},
-				{
-					'rule': 'KeepInfraAsCodeByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'.cscfg',
-						'.tfvars'
-					]
-				},
-				{
-					'rule': 'RelayRdpByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.rdp'
-					],
-					'relay_configs': [
-						'KeepRdpPasswords'
-					]
-				},
-				{
-					'rule': 'RelayJsByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.js',
-						'.cjs',
-						'.mjs',
-						'.cs',
-						'.ts',
-						'.tsx',
-						'.ls',
-						'.es6',
-						'.es'
-					],
-					'relay_configs': [
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation',
-						'KeepDbConnStringPw'
-					]
-				},
-				{
-					'rule': 'RelayCSharpByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.aspx',
-						'.ashx',
-						'.asmx',
-						'.asp',
-						'.cshtml',
-						'.cs',
-						'.ascx',
-						'.config'
-					],
-					'relay_configs': [
-						'KeepCSharpDbConnStringsYellow',
-						'KeepCSharpDbConnStringsRed',
-						'KeepCSharpViewstateKeys',
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation',
-						'KeepDbConnStringPw',
-						'KeepCSharpDbConnStringsRed',
-						'KeepCSharpDbConnStringsYellow'
-					]
-				},
-				{
-					'rule': 'KeepDeployImageByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Yellow',
-					'wordlist': [
-						'.wim',
-						'.ova',
-						'.ovf'
-					]
-				},
-				{
-					'rule': 'RelayShellScriptByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.netrc',
-						'.exports',
-						'.functions',
-						'.extra',
-						'.npmrc',
-						'.env',
-						'.bashrc',
-						'.profile',
-						'.zshrc',
-						'.bash_history',
-						'.zsh_history',
-						'.sh_history',
-						'zhistory',
-						'.irb_history'
-					],
-					'relay_configs': [
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation'
-					]
-				},
-				{
-					'rule': 'RelayPerlByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.pl'
-					],
-					'relay_configs': [
-						'KeepPerlDbConnStrings',
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation',
-						'KeepDbConnStringPw'
-					]
-				},
-				{
-					'rule': 'KeepSSHKeysByFileExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'.ppk'
-					]
-				},
-				{
-					'rule': 'RelayConfigByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.yaml',
-						'.yml',
-						'.toml',
-						'.xml',
-						'.json',
-						'.config',
-						'.ini',
-						'.inf',
-						'.cnf',
-						'.conf',
-						'.properties',
-						'.env',
-						'.dist',
-						'.txt',
-						'.sql',
-						'.log',
-						'.sqlite',
-						'.sqlite3',
-						'.fdb',
-						'.tfvars'
-					],
-					'relay_configs': [
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation',
-						'KeepDbConnStringPw'
-					]
-				},
-				{
-					'rule': 'RelayInfraConfigByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.xml',
-						'.json',
-						'.config',
-						'.ini',
-						'.inf',
-						'.cnf',
-						'.conf',
-						'.txt'
-					],
-					'relay_configs': [
-						'KeepNetConfigCreds'
-					]
-				},
-				{
-					'rule': 'KeepKerberosCredentialsByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Yellow',
-					'wordlist': [
-						'.keytab',
-						'.ccache'
-					]
-				},
-				{
-					'rule': 'RelayVBScriptByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.vbs',
-						'.vbe',
-						'.wsf',
-						'.wsc',
-						'.asp',
-						'.hta'
-					],
-					'relay_configs': [
-						'KeepCmdCredentials',
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation',
-						'KeepDbConnStringPw',
-						'KeepCSharpDbConnStringsRed',
-						'KeepCSharpDbConnStringsYellow'
-					]
-				},
-				{
-					'rule': 'RelayRubyByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.rb'
-					],
-					'relay_configs': [
-						'KeepRubyDbConnStrings',
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation',
-						'KeepDbConnStringPw'
-					]
-				},
-				{
-					'rule': 'KeepRemoteAccessConfByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Yellow',
-					'wordlist': [
-						'.rdg',
-						'.rtsz',
-						'.rtsx',
-						'.ovpn',
-						'.tvopt',
-						'.sdtid'
-					]
-				},
-				{
-					'rule': 'RelayPsByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.psd1',
-						'.psm1',
-						'.ps1'
-					],
-					'relay_configs': [
-						'KeepPsCredentials',
-						'KeepCmdCredentials',
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation',
-						'KeepDbConnStringPw'
-					]
-				},
-				{
-					'rule': 'RelayJavaByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.jsp',
-						'.do',
-						'.java',
-						'.cfm'
-					],
-					'relay_configs': [
-						'KeepJavaDbConnStrings',
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation',
-						'KeepDbConnStringPw'
-					]
-				},
-				{
-					'rule': 'RelayPythonByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.py'
-					],
-					'relay_configs': [
-						'KeepPyDbConnStrings',
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation',
-						'KeepDbConnStringPw'
-					]
-				},
-				{
-					'rule': 'RelayPhpByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.php',
-						'.phtml',
-						'.inc',
-						'.php3',
-						'.php5',
-						'.php7'
-					],
-					'relay_configs': [
-						'KeepPhpDbConnStrings',
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation',
-						'KeepDbConnStringPw'
-					]
-				},
-				{
-					'rule': 'KeepPcapByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Yellow',
-					'wordlist': [
-						'.pcap',
-						'.cap',
-						'.pcapng'
-					]
-				},
-				{
-					'rule': 'RelayCmdByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Relay',
-					'triage': 'Green',
-					'wordlist': [
-						'.bat',
-						'.cmd'
-					],
-					'relay_configs': [
-						'KeepCmdCredentials',
-						'KeepAwsKeysInCode',
-						'KeepInlinePrivateKey',
-						'KeepPassOrKeyInCode',
-						'KeepSlackTokensInCode',
-						'KeepSqlAccountCreation'
-					]
-				},
-				{
-					'rule': 'KeepPassMgrsByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Black',
-					'wordlist': [
-						'.kdbx',
-						'.kdb',
-						'.psafe3',
-						'.kwallet',
-						'.keychain',
-						'.agilekeychain',
-						'.cred'
-					]
-				},
-				{
-					'rule': 'KeepMemDumpByExtension',
-					'target': 'FileExtension',
-					'match_type': 'Exact',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						'.dmp'
-					]}
-			],
-			'Relay': {
-				'KeepPassOrKeyInCode': {
-					'rule': 'KeepPassOrKeyInCode',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'passw?o?r?d\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
-						b'api[Kk]ey\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
-						b'passw?o?r?d?>\\s*[^\\s<]+\\s*<',
-						b'passw?o?r?d?>.{3,2000}</pass',
-						b'api[kK]ey>\\s*[^\\s<]+\\s*<',
-						b'[_\\-\\.]oauth\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
-						b'client_secret\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
-						b'<ExtendedMatchKey>ClientAuth'
-					]
-				},
-				'KeepPyDbConnStrings': {
-					'rule': 'KeepPyDbConnStrings',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'mysql\\.connector\\.connect\\(',
-						b'psycopg2\\.connect\\('
-					]
-				},
-				'KeepRubyDbConnStrings': {
-					'rule': 'KeepRubyDbConnStrings',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'DBI\\.connect\\('
-					]
-				},
-				'KeepCSharpViewstateKeys': {
-					'rule': 'KeepCSharpViewstateKeys',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'validationkey\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
-						b'decryptionkey\\s*=\\s*[\\\'\\"][^\\\'\\"]....'
-					]
-				},
-				'KeepRdpPasswords': {
-					'rule': 'KeepRdpPasswords',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'password 51\\:b'
-					]
-				},
-				'KeepJavaDbConnStrings': {
-					'rule': 'KeepJavaDbConnStrings',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'\\.getConnection\\(\\"jdbc\\:',
-						b'passwo?r?d\\s*=\\s*[\\\'\\"][^\\\'\\"]....'
-					]
-				},
-				'KeepCSharpDbConnStringsYellow': {
-					'rule': 'KeepCSharpDbConnStringsYellow',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Yellow',
-					'wordlist': [
-						b'Data Source=.+Integrated Security=(SSPI|true)',
-						b'Integrated Security=(SSPI|true);.*Data Source=.+'
-					]
-				},
-				'KeepCSharpDbConnStringsRed': {
-					'rule': 'KeepCSharpDbConnStringsRed',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'Data Source=.+(;|)Password=.+(;|)',
-						b'Password=.+(;|)Data Source=.+(;|)'
-					]
-				},
-				'KeepS3UriPrefixInCode': {
-					'rule': 'KeepS3UriPrefixInCode',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Yellow',
-					'wordlist': [
-						b's3[a]?:\\/\\/[a-zA-Z0-9\\-\\+\\/]{2,16}'
-					]
-				},
-				'KeepDbConnStringPw': {
-					'rule': 'KeepDbConnStringPw',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Yellow',
-					'wordlist': [
-						b'connectionstring.{1,200}passw'
-					]
-				},
-				'KeepUnattendXmlRegexRed': {
-					'rule': 'KeepUnattendXmlRegexRed',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'(?s)<AdministratorPassword>.{0,30}<Value>.*<\\/Value>',
-						b'(?s)<AutoLogon>.{0,30}<Value>.*<\\/Value>'
-					]
-				},
-				'KeepPsCredentials': {
-					'rule': 'KeepPsCredentials',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'-SecureString',
-						b'-AsPlainText',
-						b'\\[Net.NetworkCredential\\]::new\\('
-					]
-				},
-				'KeepCmdCredentials': {
-					'rule': 'KeepCmdCredentials',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'passwo?r?d\\s*=\\s*[\\\'\\"][^\\\'\\"]....',
-						b'schtasks.{1,300}(/rp\\s|/p\\s)',
-						b'net user ',
-						b'psexec .{0,100} -p ',
-						b'net use .{0,300} /user:',
-						b'cmdkey '
-					]
-				},
-				'KeepPhpDbConnStrings': {
-					'rule': 'KeepPhpDbConnStrings',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'mysql_connect\\s*\\(.*\\$.*\\)',
-						b'mysql_pconnect\\s*\\(.*\\$.*\\)',
-						b'mysql_change_user\\s*\\(.*\\$.*\\)',
-						b'pg_connect\\s*\\(.*\\$.*\\)',
-						b'pg_pconnect\\s*\\(.*\\$.*\\)'
-					]
-				},
-				'KeepInlinePrivateKey': {
-					'rule': 'KeepInlinePrivateKey',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'-----BEGIN( RSA| OPENSSH| DSA| EC| PGP)? PRIVATE KEY( BLOCK)?-----'
-					]
-				},
-				'KeepFFRegexRed': {
-					'rule': 'KeepFFRegexRed',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'"encryptedPassword":"[A-Za-z0-9+/=]+"'
-					]
-				},
-				'KeepSlackTokensInCode': {
-					'rule': 'KeepSlackTokensInCode',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'(xox[pboa]-[0-9]{12}-[0-9]{12}-[0-9]{12}-[a-z0-9]{32})',
-						b'https://hooks.slack.com/services/T[a-zA-Z0-9_]{8}/B[a-zA-Z0-9_]{8}/[a-zA-Z0-9_]{24}'
-					]
-				},
-				'KeepNetConfigCreds': {
-					'rule': 'KeepNetConfigCreds',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'NVRAM config last updated',
-						b'enable password \\.',
-						b'simple-bind authenticated encrypt',
-						b'pac key [0-7] ',
-						b'snmp-server community\\s.+\\sRW'
-					]
-				},
-				'KeepAwsKeysInCode': {
-					'rule': 'KeepAwsKeysInCode',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'aws[_\\-\\.]?key',
-						b'(\\s|\\\'|\\"|\\^|=)(A3T[A-Z0-9]|AKIA|AGPA|AROA|AIPA|ANPA|ANVA|ASIA)[A-Z2-7]{12,16}(\\s|\\\'|\\"|$)'
-					]
-				},
-				'KeepSqlAccountCreation': {
-					'rule': 'KeepSqlAccountCreation',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'CREATE (USER|LOGIN) .{0,200} (IDENTIFIED BY|WITH PASSWORD)'
-					]
-				},
-				'KeepPerlDbConnStrings': {
-					'rule': 'KeepPerlDbConnStrings',
-					'target': 'FileContentAsString',
-					'match_type': 'Regex',
-					'action': 'Snaffle',
-					'triage': 'Red',
-					'wordlist': [
-						b'DBI\\-\\>connect\\('
-					]
-				}
-			}
-		}
+		# Largest file to content scan, and to consider at all
+		self.max_size = options.get("max_size", 10 * 1024 * 1024)
+		self.discard_size = options.get("discard_size", 0)
+		self.scan_buffer = options.get("scan_buffer", 1024 * 1024)
+		self.read_size = self._negotiate_read_size(options.get("read_size", 1024 * 1024))
+		self.read_depth = max(1, options.get("read_depth", 4))
+		self.scan_head = options.get("scan_head", 0)
+		self.scan_tail = options.get("scan_tail", 0)
+		# Skip binaries and read UTF-16 text as UTF-8, judging by the first block
+		self.sniff_content = options.get("sniff_content", True)
+		self.workers = max(1, options.get("workers", 1))
+		self.max_depth = options.get("max_depth", 0)
+		self.max_dir_entries = options.get("max_dir_entries", 0)
+		self.priority_folders = _alternation(options.get("priority_folders", PRIORITY_FOLDERS))
+		self.connections = ConnectionPool(smb, logger, self.workers, options.get("reconnect_attempts", 5), options.get("reconnect_delay", 1.0), options.get("reconnect_max_delay", 30.0))
+		# Budgets, with where the crawl of a share stopped once one is spent
+		self.host_budget = CrawlBudget(options.get("host_time_limit", 0), options.get("host_byte_limit", 0), options.get("host_file_limit", 0))
+		self.share_limits = (options.get("share_time_limit", 0), options.get("share_byte_limit", 0), options.get("share_file_limit", 0))
+		self.share_budgets = {}
+		self.stopped = {}
+		self._stop_lock = threading.Lock()
+		# Checkpoint of finished folders and files, and whether to skip them
+		self.state = options.get("state")
+		self.resume = options.get("resume", False) and self.state is not None
+		self._outstanding = {}
+		self._incomplete = set()
+		# Fingerprints and findings of earlier runs for incremental re-scans
+		self.index = options.get("index")
+		self.skip_unchanged_dirs = options.get("skip_unchanged_dirs", False) and self.index is not None
+		# Listings shared with other hosts, keyed on the server the session really reached
+		self.listings = options.get("listings")
+		self.server_id = self._server_id()
+		# Relay rules that ShareName rules apply to every file of a share
+		self.share_relays = {}
+		self.cert_passwords = options.get("cert_passwords", CERT_PASSWORDS)
+		# Limits on looking inside zip based archives, a depth of 0 leaves them closed
+		self.archive_max_depth = options.get("archive_max_depth", 2)
+		self.archive_max_members = options.get("archive_max_members", 1000)
+		self.archive_max_bytes = options.get("archive_max_bytes", 100 * 1024 * 1024)
+		# Documents whose text parts are scanned as text, and how much text one may yield
+		self.document_parts = {ext: re.compile(DOCUMENT_PARTS[ext]) for ext in options.get("extract_text", DOCUMENT_PARTS) if ext in DOCUMENT_PARTS}
+		self.extract_max_bytes = options.get("extract_max_bytes", 10 * 1024 * 1024)
+		# Findings of identical content already scanned on this or another host
+		self.dedupe = options.get("dedupe")
+		# Console and structured output of findings, off the crawl threads
+		self.writer = options.get("writer") or FindingWriter()
+		self._track_lock = threading.Lock()
+		# Crawl frontier shared by the workers, each extra worker owns an SMB connection
+		self.jobs = None
+		self._job_order = itertools.count()
+		self.compiled = options.get("compiled_rules", COMPILED_RULES)
+		self.rules = self.compiled.rules
+		self.folder_filter = FOLDER_FILTER
 
-	def _test_file(self, share_name: str, full_path: str, filename: str, fileext: str) -> None:
-		'''Run a series of file path, name, ext, and content checks'''
-		for category in ["FilePath", "FileName", "FileExtension"]:
-			self._match_content(share_name, full_path, filename, fileext, category)
-
-	def _match_content(self, share_name: str, full_path: str, filename: str, fileext: str, category: str) -> None:
-		'''Trigger snaffle or relay actions based on file path'''
-		# Initialize file content
-		file_contents = b''
-		# Get search content
-		content = self._get_search_content(full_path, filename, fileext, category)
-		# Iterate over the relevant rules
-		for rule in self.rules[category]:
-			match_function = self._get_match_function(rule)
+	def _test_file(self, share_name: str, full_path: str, filename: str, fileexts: tuple, size: int = None, mtime: int = None, indexed: tuple = None) -> bool:
+		'''Run a series of file path, name, ext, and content checks, returning True if a content scan was queued'''
+		# Unchanged since an earlier run, report what that run found
+		if indexed and indexed[3] and indexed[0] == size and indexed[1] == mtime:
+			for finding in indexed[2]:
+				# Content matches are stored as text but logged as the bytes a fresh scan finds
+				match = finding[2].encode() if finding[1] in self.compiled.relay else finding[2]
+				# Findings inside archives carry the path of their member
+				self._log_snaffle(finding[0], finding[1], share_name, finding[4] if len(finding) > 4 else full_path, match, finding[3], size, mtime)
+			if self.state:
+				self.state.finish_file(self.host, share_name, full_path)
+			return False
+		# Name, path and extension rules first, collecting every relay and key rule they trigger
+		relay_configs = list(self.share_relays.get(share_name, ()))
+		key_rules = []
+		findings = []
+		for category in FILE_CATEGORIES:
+			relay_configs.extend(self._match_content(share_name, full_path, filename, fileexts, category, findings, size, mtime, key_rules))
+		# Archives are only partly fetched, their relay rules apply to the members
+		fileext = fileexts[-1].lower()
+		archive = size is not None and (fileext in self.document_parts or (self.archive_max_depth > 0 and fileext in ZIP_EXTENSIONS))
+		# Oversize files keep their name, path and extension findings but are never fetched
+		if (relay_configs or key_rules) and size is not None and size > self.max_size and not archive:
+			self.logger.debug(f"Not content scanning //{self.host}/{share_name}{full_path}, {size} bytes is over MAX_FILE_SIZE")
+			relay_configs = key_rules = []
+		if self.index:
+			self.index.record_file(self.host, share_name, full_path, size, mtime, findings, not relay_configs and not key_rules and not archive)
+		# Fetch and scan the file at most once for the union of relay rules
+		if relay_configs or key_rules or archive:
+			self._queue(("scan", share_name, full_path, relay_configs, size, mtime, key_rules, archive))
+			return True
+		if self.state:
+			self.state.finish_file(self.host, share_name, full_path)
+		return False
+
+	def _content_scan(self, share_name: str, full_path: str, relay_configs: list, size: int = None, mtime: int = None, key_rules: list = (), archive: bool = False) -> bool:
+		'''Scan file contents with relay and key rules and log the findings, returning False if cut short by a budget'''
+		if archive:
+			findings, partial = self._scan_archive(share_name, full_path, relay_configs, size, mtime)
+		else:
+			hits, partial, origin = [], False, None
+			# Key rules look at the bytes the relay scan reads rather than reading the file again
+			data = None
+			if relay_configs:
+				data = bytearray() if key_rules else None
+				hits, partial, origin = self._scan_file(share_name, full_path, relay_configs, size, data)
+			if origin:
+				self._log_duplicate(share_name, full_path, origin, hits, size, mtime)
+			for rr, m in hits if not origin else ():
+				self._log_snaffle(rr["triage"], rr["rule"], share_name, full_path, m, partial, size, mtime)
+			if key_rules and not partial:
+				key_hits = self._check_keys(share_name, full_path, key_rules, size, data)
+				for rr, m in key_hits:
+					self._log_snaffle(rr["triage"], rr["rule"], share_name, full_path, m, False, size, mtime)
+				hits = hits + key_hits
+			# Stored as text so the index and the outputs fed from it read the same on every run
+			findings = [[rr["triage"], rr["rule"], m.decode("utf-8", "replace") if isinstance(m, bytes) else m, partial] for rr, m in hits]
+		if partial and self._over_budget(share_name, full_path, count_files=False):
+			return False
+		if self.index:
+			self.index.record_scan(self.host, share_name, full_path, findings)
+		if self.state:
+			self.state.finish_file(self.host, share_name, full_path)
+		return True
+
+	def _match_content(self, share_name: str, full_path: str, filename: str, fileexts: tuple, category: str, findings: list = None, size: int = None, mtime: int = None, key_rules: list = None) -> list:
+		'''Trigger snaffle actions based on file path and return the relay rules to run'''
+		# Relay rules to run over the file contents
+		relay_configs = []
+		# Get search content, every candidate extension for the extension rules
+		content = self._get_search_content(full_path, filename, fileexts, category)
+		# Iterate over the matching rules
+		for rule, match in self.compiled.categories[category].match_all(content):
 			# Relay Action
 			if rule["action"] == "Relay":
-				match = match_function(content, rule["wordlist"])
-				if match:
-					if not file_contents:
-						file_contents = self._download_file(share_name, full_path)
-					for relay_rule in rule["relay_configs"]:
-						rr = self.rules["Relay"][relay_rule]
-						mf = self._get_match_function(rr)
-						m = mf(file_contents, rr["wordlist"])
-						if m:
-							self._log_snaffle(rr["triage"], rr["rule"], share_name, full_path, m)
+				relay_configs.extend(rule["relay_configs"])
 			# Snaffle Action
 			elif rule["action"] == "Snaffle":
-				match = match_function(content, rule["wordlist"])
-				if match:
-					self._log_snaffle(rule["triage"], rule["rule"], share_name, full_path, match)
+				self._log_snaffle(rule["triage"], rule["rule"], share_name, full_path, match, False, size, mtime)
+				if findings is not None:
+					findings.append([rule["triage"], rule["rule"], match, False])
+			# CheckForKeys Action
+			elif rule["action"] == "CheckForKeys":
+				if key_rules is not None:
+					key_rules.append(rule)
 			# Ignore other actions
 			else:
 				pass
+		return relay_configs
+
+	def _log_duplicate(self, share_name: str, full_path: str, origin: str, hits: list, size: int = None, mtime: int = None) -> None:
+		'''Log the reused findings of a file identical to one scanned before on a single line'''
+		if not hits:
+			self.logger.debug(f"//{self.host}/{share_name}{full_path} has the same content as {origin}")
+			return
+		triage = min((rr["triage"] for rr, m in hits), key=TRIAGE_ORDER.index)
+		rule_names = ",".join(dict.fromkeys(rr["rule"] for rr, m in hits))
+		self._log_snaffle(triage, "DuplicateContent", share_name, full_path, f"same as {origin} ({rule_names})", False, size, mtime)
 
-	def _log_snaffle(self, triage: str, rule_name: str, share_name: str, full_path: str, match: bytes) -> None:
-		'''Log output of finding details to the console'''
-		now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-		self.logger.info(f'<CREDHUNT>{now}|[{triage}]|{rule_name}|//{self.host}/{share_name}{full_path}|{match}</CREDHUNT>')
+	def _log_snaffle(self, triage: str, rule_name: str, share_name: str, full_path: str, match: bytes, partial: bool = False, size: int = None, mtime: int = None) -> None:
+		'''Queue finding details for the console and the structured outputs'''
+		self.writer.emit(self.logger, (datetime.datetime.now(), triage, rule_name, self.host, share_name, full_path, match, size, mtime, partial))
 
-	def _get_search_content(self, full_path: str, filename: str, fileext: str, category: str) -> str:
-		'''Return the content string used for searching against rules'''
+	def _get_search_content(self, full_path: str, filename: str, fileexts: tuple, category: str) -> tuple:
+		'''Return the content strings used for searching against rules'''
 		if category == "FilePath":
-			content = full_path
+			content = (full_path,)
 		elif category == "FileName":
-			content = filename
+			content = (filename,)
 		elif category == "FileExtension":
-			content = fileext
+			content = fileexts
 		return content
 
-	def _get_match_function(self, rule: dict):
-		'''Return the match function'''
-		match_type = rule["match_type"]
-		if rule["match_type"] == "Exact":
-			match_function = self._exact
-		elif rule["match_type"] == "Regex":
-			match_function = self._regex
-		elif rule["match_type"] == "Contains":
-			match_function = self._contains
-		elif rule["match_type"] == "EndsWith":
-			match_function = self._endswith
-		return match_function
-
-	def _exact(self, target: str, wordlist: list) -> str:
-		'''Return matching string if target equals wordlist word'''
-		t = target.lower()
-		for i in wordlist:
-			if t == i:
-				return i
-		return ""
+	def _negotiate_read_size(self, read_size: int) -> int:
+		'''Return the read size capped to the server MaxReadSize'''
+		try:
+			max_read = self.smb.conn.getIOCapabilities()["MaxReadSize"]
+		except Exception:
+			max_read = 65536
+		return max(1, min(read_size, max_read))
 
-	def _regex(self, target: str, wordlist: list) -> str:
-		'''Return matching string if target matches wordlist regex'''
-		for i in wordlist:
-			regex = re.compile(i, re.I)
-			match = regex.search(target)
-			if match:
-				return match.string[match.start():match.end()]
-		return ""
+	def _read_range(self, conn, tid, fid, offset: int = 0, length: int = None):
+		'''Yield chunks of a file byte range, pipelining reads over SMB2/3 when read_depth allows'''
+		end = None if length is None else offset + length
+		server = conn.getSMBServer()
+		if self.read_depth > 1 and isinstance(server, SMB3):
+			yield from self._pipelined_reads(server, tid, fid, offset, end)
+			return
+		while end is None or offset < end:
+			request = self.read_size if end is None else min(self.read_size, end - offset)
+			chunk = conn.readFile(tid, fid, offset, request)
+			if not chunk:
+				break
+			offset += len(chunk)
+			yield chunk
 
-	def _contains(self, target: str, wordlist: list) -> str:
-		'''Return matching string if target contains wordlist word'''
-		t = target.lower()
-		for i in wordlist:
-			if i in t:
-				return i
-		return ""
+	def _send_read(self, server, tid, fid, offset: int, length: int) -> int:
+		'''Send an SMB2 READ request without waiting and return its message id'''
+		packet = server.SMB_PACKET()
+		packet["Command"] = SMB2_READ
+		packet["TreeID"] = tid
+		charge = 1
+		if server._Connection["Dialect"] != SMB2_DIALECT_002 and server._Connection["SupportsMultiCredit"] is True:
+			charge = 1 + (length - 1) // 65536
+			packet["CreditCharge"] = charge
+		smb_read = SMB2Read()
+		smb_read["Padding"] = 0x50
+		smb_read["FileID"] = fid
+		smb_read["Length"] = length
+		smb_read["Offset"] = offset
+		packet["Data"] = smb_read
+		message_id = server.sendSMB(packet)
+		# sendSMB takes one message id, a multi-credit request uses up charge of them
+		server._Connection["SequenceWindow"] += charge - 1
+		return message_id
 
-	def _endswith(self, target: str, wordlist: list) -> str:
-		'''Return matching string if target ends with wordlist word'''
-		t = target.lower()
-		for i in wordlist:
-			if t.endswith(i):
-				return i
-		return ""
+	def _recv_read(self, server, message_id: int) -> bytes:
+		'''Wait for an SMB2 READ response, returning an empty string at end of file'''
+		# recvSMB adds the credit charge to the window again, _send_read already reserved it
+		window = server._Connection["SequenceWindow"]
+		try:
+			answer = server.recvSMB(message_id)
+			if answer.isValidAnswer(STATUS_SUCCESS):
+				return SMB2Read_Response(answer["Data"])["Buffer"]
+		except SMB3SessionError as e:
+			if e.get_error_code() == STATUS_END_OF_FILE:
+				return b""
+			raise
+		finally:
+			server._Connection["SequenceWindow"] = window
+		return b""
+
+	def _pipelined_reads(self, server, tid, fid, offset: int = 0, end: int = None):
+		'''Yield file chunks up to end keeping up to read_depth READ requests outstanding'''
+		length = self.read_size
+		if server._Connection["Dialect"] == SMB2_DIALECT_002 or server._Connection["SupportsMultiCredit"] is not True:
+			length = min(length, 65536)
+		in_flight = deque()
+		try:
+			while True:
+				while len(in_flight) < self.read_depth and (end is None or offset < end):
+					request = length if end is None else min(length, end - offset)
+					in_flight.append((self._send_read(server, tid, fid, offset, request), offset, request))
+					offset += request
+				if not in_flight:
+					break
+				message_id, start, request = in_flight.popleft()
+				chunk = self._recv_read(server, message_id)
+				if chunk:
+					yield chunk
+				if len(chunk) < request:
+					# Short read, drop the requests sent past it and carry on from there
+					while in_flight:
+						self._recv_read(server, in_flight.popleft()[0])
+					if not chunk or (end is not None and start + len(chunk) >= end):
+						break
+					offset = start + len(chunk)
+		finally:
+			# Collect answers left behind when the caller stops early
+			while in_flight:
+				try:
+					self._recv_read(server, in_flight.popleft()[0])
+				except Exception:
+					pass
 
-	def _read_chunk(self, file_handle, chunk_size=4096):
-		'''Read a file chunk'''
-		chunk = b""
-		retry = 3
-		while retry > 0:
-			retry -= 1
+	def _sample_ranges(self, relay_configs: list, size: int = None) -> tuple:
+		'''Return the (offset, length) ranges to content scan and whether they skip part of the file'''
+		heads = []
+		tails = []
+		for name in relay_configs:
+			rule = self.compiled.relay[name].rule
+			heads.append(rule.get("scan_head", self.scan_head))
+			tails.append(rule.get("scan_tail", self.scan_tail))
+		head = max(heads)
+		tail = max(tails) if size is not None else 0
+		# Any rule asking for the whole file gets the whole file
+		if not head or 0 in heads or (size is not None and head + tail >= size):
+			return [(0, size)], False
+		ranges = [(0, head)]
+		if tail:
+			ranges.append((size - tail, tail))
+		return ranges, size is None or size > head + tail
+
+	def _scan_file(self, share: str, path: str, relay_configs: list, size: int = None, keep: bytearray = None) -> tuple:
+		'''Stream file contents through relay rules, copying the first MAX_FILE_SIZE bytes into keep if given, and return (rule, match) hits, whether the scan was partial and the origin of identical content'''
+		scanner = ContentScanner(self.compiled, relay_configs, self.scan_buffer, self.sniff_content)
+		ranges, partial = self._sample_ranges(relay_configs, size)
+		started = time.monotonic()
+		over_budget = False
+		hits = None
+		origin = None
+		transferred = 0
+		limit = self.max_size if size is None else min(size, self.max_size)
+		# Reading goes on after the rules are done until keep holds its bytes
+		satisfied = lambda: scanner.done and (keep is None or len(keep) >= limit)
+		try:
+			handle = self._open_file(share, path)
 			try:
-				chunk = file_handle.read(chunk_size)
-				break
-			except SessionError:
-				if self._reconnect():
-					# Reset the smb connection
-					file_handle.__smbConnection = self.smb.conn
-					return self._read_chunk(file_handle)
+				# Only whole files of a known size can be matched to content scanned before
+				if self.dedupe is not None and size is not None and not partial and keep is None:
+					hits, origin, over_budget = self._dedupe_scan(handle, share, path, relay_configs, size, scanner)
+				else:
+					for offset, length in ranges:
+						if satisfied():
+							break
+						for chunk in self._file_chunks(handle, share, path, offset, length):
+							if keep is not None and offset == 0 and len(keep) < limit:
+								keep += chunk[:limit - len(keep)]
+							if not scanner.done:
+								scanner.feed(chunk)
+							# Stop reading once every relay rule has fired
+							if satisfied():
+								break
+						if not satisfied() and self._over_budget(share, path, count_files=False):
+							over_budget = True
+							break
+						# Matches must not span the gap between head and tail
+						scanner.flush()
+			finally:
+				transferred = handle[3]
+				self._close_file(handle)
+		except Exception as e:
+			self.logger.debug(f"Error reading //{self.host}/{share}{path}: {str(e)}")
+			over_budget = True
+		if size is None and partial:
+			# Without a listing size a short head read means the whole file was seen
+			partial = scanner.bytes_scanned >= ranges[0][1]
+		partial = partial or over_budget
+		elapsed = max(time.monotonic() - started, 1e-6)
+		if scanner.binary:
+			self.logger.debug(f"Not content scanning //{self.host}/{share}{path}, its first block looks binary")
+		self.logger.debug(f"Read {transferred} bytes of //{self.host}/{share}{path} in {elapsed:.2f}s ({transferred / elapsed:.0f} B/s)")
+		return (scanner.finish() if hits is None else hits), partial, origin
+
+	def _open_file(self, share: str, path: str) -> list:
+		'''Borrow a pooled connection and open a file on it, returning the [member, tree id, file id, bytes read] handle'''
+		member = self.connections.acquire()
+		try:
+			return [member] + self._retrying(member, lambda: self._open_on(member, share, path)) + [0]
+		except Exception:
+			self.connections.release(member)
+			raise
+
+	def _open_on(self, member: PooledConnection, share: str, path: str) -> list:
+		'''Open a file for reading on a pooled connection and return its [tree id, file id]'''
+		tid = member.tree(share)
+		return [tid, member.conn.openFile(tid, path, desiredAccess=FILE_READ_DATA)]
+
+	def _close_file(self, handle: list) -> None:
+		'''Close a file handle, whose connection may already be gone, and give the connection back'''
+		try:
+			handle[0].conn.closeFile(handle[1], handle[2])
+		except Exception:
+			pass
+		self.connections.release(handle[0])
+
+	def _file_chunks(self, handle: list, share: str, path: str, offset: int = 0, length: int = None):
+		'''Yield chunks of a file byte range counted against the budgets, resuming at the failed offset if the session drops'''
+		end = None if length is None else offset + length
+		retries = 0
+		while True:
+			chunks = self._read_range(handle[0].conn, handle[1], handle[2], offset, None if end is None else end - offset)
+			try:
+				for chunk in chunks:
+					offset += len(chunk)
+					handle[3] += len(chunk)
+					self._spend(share, nbytes=len(chunk))
+					yield chunk
+					if self._over_budget(share, path, count_files=False):
+						return
+				return
 			except Exception as e:
-				break
-		return chunk
+				if retries >= self.connections.retries or not self.connections.lost(e) or not self.connections.reconnect(handle[0]):
+					raise
+				retries += 1
+				self.logger.debug(f"Resuming //{self.host}/{share}{path} at byte {offset}: {str(e)}")
+				# The file id went with the old session
+				handle[1:3] = self._retrying(handle[0], lambda: self._open_on(handle[0], share, path))
+			finally:
+				chunks.close()
+
+	def _retrying(self, member: PooledConnection, operation):
+		'''Run an SMB operation, reconnecting the member and running it again while the session is what failed'''
+		for attempt in range(self.connections.retries + 1):
+			try:
+				return operation()
+			except Exception as e:
+				if attempt == self.connections.retries or not self.connections.lost(e) or not self.connections.reconnect(member):
+					raise
+
+	def _dedupe_scan(self, handle: list, share: str, path: str, relay_configs: list, size: int, scanner: ContentScanner) -> tuple:
+		'''Scan a whole file unless identical content was scanned before, returning (hits or None, origin, over budget)'''
+		block = self.dedupe.block_size
+		if size <= 2 * block:
+			# Small files are fingerprinted on their whole content, so a match is exact
+			content = b"".join(self._file_chunks(handle, share, path, 0, size))
+			if len(content) < size:
+				scanner.feed(content)
+				return None, None, True
+			fingerprint = self.dedupe.fingerprint(size, content)
+			known = self.dedupe.lookup(fingerprint, relay_configs)
+			if known:
+				return self.dedupe.reuse(known[0], relay_configs), known[0][1], False
+			scanner.feed(content)
+			hits = scanner.finish()
+			self.dedupe.add(fingerprint, hashlib.sha256(content).hexdigest(), f"//{self.host}/{share}{path}", relay_configs, hits)
+			return hits, None, False
+		head = b"".join(self._file_chunks(handle, share, path, 0, block))
+		scanner.feed(head)
+		if len(head) < block:
+			return None, None, True
+		# A binary file or one whose rules all fired is not read any further just to fingerprint it
+		if scanner.done:
+			return scanner.finish(), None, False
+		tail = b"".join(self._file_chunks(handle, share, path, size - block, block))
+		if len(tail) < block:
+			return None, None, True
+		fingerprint = self.dedupe.fingerprint(size, head + tail)
+		known = self.dedupe.lookup(fingerprint, relay_configs)
+		if known and self.dedupe.trust_precheck:
+			return self.dedupe.reuse(known[0], relay_configs), known[0][1], False
+		# The head and tail already read are not fetched again
+		digest = hashlib.sha256(head)
+		read = block
+		for chunk in self._file_chunks(handle, share, path, block, size - 2 * block):
+			digest.update(chunk)
+			read += len(chunk)
+			if not scanner.done:
+				scanner.feed(chunk)
+			elif not known:
+				# Only a possible duplicate has to be hashed to the end, other files are not cached
+				return scanner.finish(), None, False
+		if read < size - block:
+			return None, None, True
+		digest.update(tail)
+		for entry in known:
+			if entry[0] == digest.hexdigest():
+				return self.dedupe.reuse(entry, relay_configs), entry[1], False
+		scanner.feed(tail)
+		hits = scanner.finish()
+		self.dedupe.add(fingerprint, digest.hexdigest(), f"//{self.host}/{share}{path}", relay_configs, hits)
+		return hits, None, False
 
-	def _download_file(self, share: str, path: str) -> bytes:
-		'''Download file contents in 4kb chunks and return'''
-		contents = b""
+	def _scan_archive(self, share: str, path: str, relay_configs: list, size: int, mtime: int = None) -> tuple:
+		'''Run the rules over the members of a zip based archive, returning index findings and whether the scan was partial'''
 		try:
-			fh = RemoteFile(self.smb.conn, path, share, access=FILE_READ_DATA)
-			fh.open()
-			while True:
-				chunk = self._read_chunk(fh)
-				contents += chunk
-				if not chunk:
-					break
-			fh.close()
+			handle = self._open_file(share, path)
+			try:
+				archive = ZipArchive(lambda offset, length: self._file_chunks(handle, share, path, offset, length), size)
+				return self._scan_members(share, path, archive, relay_configs, mtime, 1, [self.archive_max_bytes])
+			finally:
+				self._close_file(handle)
 		except Exception as e:
-			if self._reconnect():
-				return self._download_file(share, path)
-		return contents
-
-	def _is_interesting_share(self, share_name: str) -> bool:
-		'''Return true if this share should be noted but not spidered'''
-		sname = share_name.lower()
-		interesting = [
-			"netlogon",
-			"sysvol",
-			"c$",
-			"admin$",
-			"sccmcontentlib$"
-		]
-		for share in interesting:
-			if sname == share:
-				return True
-		return False
+			self.logger.debug(f"Error reading archive //{self.host}/{share}{path}: {str(e)}")
+		return [], True
 
-	def _is_crawlable(self, share_name: str) -> bool:
-		'''Return true if share is of interest'''
-		sname = share_name.lower()
-		do_not_crawl = [
-			"print$",
-			"ipc$"
-		]
-		for share in do_not_crawl:
-			if sname == share:
-				return False
-		return True
+	def _scan_members(self, share: str, path: str, archive: ZipArchive, relay_configs: list, mtime: int, depth: int, budget: list) -> tuple:
+		'''Run name rules over archive members and content scan the ones they select, spending the decompressed byte budget'''
+		findings = []
+		partial = False
+		# Documents get the relay rules of the document on the text of their text parts only
+		parts = self.document_parts.get(self._get_file_exts(self._get_filename(path))[-1].lower())
+		max_text = [self.extract_max_bytes]
+		members = [member for member in archive.members() if not member.directory]
+		if self.archive_max_members and len(members) > self.archive_max_members:
+			self.logger.debug(f"Only inspecting {self.archive_max_members} of the {len(members)} members of //{self.host}/{share}{path}")
+			members = members[:self.archive_max_members]
+			partial = True
+		for member in members:
+			member_path = f"{path}!/{member.name}"
+			filename = self._get_filename(member_path)
+			fileexts = self._get_file_exts(filename)
+			if self.compiled.discard.discards(member_path, filename, fileexts, member.size, self.discard_size):
+				continue
+			member_relays = list(relay_configs)
+			key_rules = []
+			named = []
+			for category in FILE_CATEGORIES:
+				member_relays.extend(self._match_content(share, member_path, filename, fileexts, category, named, member.size, mtime, key_rules))
+			findings.extend(finding + [member_path] for finding in named)
+			text = parts is not None and parts.fullmatch(member.name) is not None
+			if parts is not None:
+				member_relays = relay_configs if text else []
+			nested = depth < self.archive_max_depth and fileexts[-1].lower() in ZIP_EXTENSIONS
+			if not (member_relays or key_rules or nested):
+				continue
+			if not member.readable or member.size > self.max_size:
+				self.logger.debug(f"Not content scanning //{self.host}/{share}{member_path}, it is encrypted, compressed with method {member.method} or over MAX_FILE_SIZE")
+				continue
+			if member.size > budget[0]:
+				self.logger.debug(f"Not content scanning //{self.host}/{share}{member_path}, ARCHIVE_MAX_BYTES is spent")
+				partial = True
+				continue
+			if text:
+				scanner = XMLTextScanner(self.compiled, member_relays, self.scan_buffer, max_text)
+			else:
+				scanner = ContentScanner(self.compiled, member_relays, self.scan_buffer, self.sniff_content)
+			# Keys and nested archives are parsed from the whole member
+			content = bytearray() if key_rules or nested else None
+			read = 0
+			cut = False
+			for chunk in archive.extract(member, member.size):
+				budget[0] -= len(chunk)
+				read += len(chunk)
+				scanner.feed(chunk)
+				if content is not None:
+					content += chunk
+				elif scanner.done:
+					break
+			else:
+				# Short of the listed size, the member data is truncated or corrupt
+				cut = read < member.size
+			if text and max_text[0] <= 0:
+				self.logger.debug(f"Stopped extracting text from //{self.host}/{share}{path} after EXTRACT_MAX_BYTES")
+				cut = True
+			for rr, m in scanner.finish():
+				self._log_snaffle(rr["triage"], rr["rule"], share, member_path, m, cut, member.size, mtime)
+				findings.append([rr["triage"], rr["rule"], m.decode("utf-8", "replace"), cut, member_path])
+			partial = partial or cut
+			if content is None or cut:
+				continue
+			found = find_private_key(bytes(content), self.cert_passwords) if key_rules else ""
+			for rr in key_rules if found else ():
+				self._log_snaffle(rr["triage"], rr["rule"], share, member_path, found, False, member.size, mtime)
+				findings.append([rr["triage"], rr["rule"], found, False, member_path])
+			if nested:
+				inner = ZipArchive(lambda offset, length, data=bytes(content): (data[offset:offset + length],), len(content))
+				try:
+					inner_findings, inner_partial = self._scan_members(share, member_path, inner, member_relays, mtime, depth + 1, budget)
+				except Exception as e:
+					self.logger.debug(f"Error reading archive //{self.host}/{share}{member_path}: {str(e)}")
+					inner_findings, inner_partial = [], True
+				findings.extend(inner_findings)
+				partial = partial or inner_partial
+		return findings, partial
 
-	def _reconnect(self):
-		'''Reconnect SMB connection'''
-		for i in range(1, self.max_connection_attempts + 1):
-			time.sleep(3)
-			self.smb.create_conn_obj()
-			self.smb.login()
-			return True
-		return False
+	def _classify_share(self, share_name: str) -> bool:
+		'''Run the ShareName rules over a share, logging snaffled shares, and return True if it should be spidered'''
+		crawl = True
+		relay_configs = []
+		for rule, match in self.compiled.categories["ShareName"].match(f"\\\\{self.host}\\{share_name}"):
+			if rule["action"] == "Discard":
+				crawl = False
+			elif rule["action"] == "Snaffle":
+				self._log_snaffle(rule["triage"], rule["rule"], share_name, "", share_name)
+			elif rule["action"] == "Relay":
+				relay_configs.extend(rule["relay_configs"])
+		if relay_configs:
+			self.share_relays[share_name] = relay_configs
+		return crawl
+
+	def _check_keys(self, share: str, path: str, key_rules: list, size: int = None, data: bytes = None) -> list:
+		'''Read a certificate or key file, unless its data was already read, and return (rule, description) for the private key it holds'''
+		if data is None:
+			data = self._read_file(share, path, self.max_size if size is None else min(size, self.max_size))
+		found = find_private_key(bytes(data), self.cert_passwords)
+		return [(rule, found) for rule in key_rules] if found else []
+
+	def _read_file(self, share: str, path: str, length: int) -> bytes:
+		'''Return up to length bytes from the start of a file'''
+		try:
+			handle = self._open_file(share, path)
+			try:
+				return b"".join(self._file_chunks(handle, share, path, 0, length))
+			finally:
+				self._close_file(handle)
+		except Exception as e:
+			self.logger.debug(f"Error reading //{self.host}/{share}{path}: {str(e)}")
+		return b""
+
+	def _server_id(self) -> str:
+		'''Return the name the server gives itself with its SMB2 server GUID, the same whichever address or alias reached it, or else with the address it was reached at'''
+		try:
+			name = (self.smb.conn.getServerDNSHostName() or self.smb.conn.getServerName() or self.host).lower()
+		except Exception:
+			name = self.host.lower()
+		# Names are not unique, only servers that negotiated the same GUID share listings across addresses
+		try:
+			server = self.smb.conn.getSMBServer()
+			guid = server._Connection["ServerGuid"] if isinstance(server, SMB3) else b""
+		except Exception:
+			guid = b""
+		if isinstance(guid, bytes) and guid.strip(b"\0"):
+			return f"{name}|{guid.hex()}"
+		return f"{name}|{self.host.lower()}"
 
 	def _list_dir(self, share: str, subfolder: str) -> list:
+		'''Return a list of paths for a share folder, through the listing cache when there is one'''
+		if self.listings is None:
+			return self._list_path(share, subfolder)
+		key = "|".join((getattr(self.smb, "domain", ""), getattr(self.smb, "username", ""), self.server_id, share, subfolder)).lower()
+		return self.listings.get(key, lambda: self._list_entries(share, subfolder))
+
+	def _list_entries(self, share: str, subfolder: str) -> list:
+		'''Return the listing of a share folder as cacheable entries'''
+		return [ListingEntry(r.get_longname(), r.get_filesize(), r.get_mtime_epoch(), r.is_directory()) for r in self._list_path(share, subfolder)]
+
+	def _list_path(self, share: str, subfolder: str) -> list:
 		'''Return a list of paths for a share folder'''
-		filelist = []
+		member = self.connections.acquire()
 		try:
 			# Get file list for the current folder
-			filelist = self.smb.conn.listPath(share, subfolder + "*")
+			return self._retrying(member, lambda: member.conn.listPath(share, subfolder + "*"))
 		except SessionError as e:
 			error = str(e)
-			if "STATUS_ACCESS_DENIED" in error:
-				pass
-			elif "STATUS_OBJECT_PATH_NOT_FOUND" in error:
-				pass
-			elif "STATUS_NO_SUCH_FILE" in error:
-				pass
-			else:
-				if self._reconnect():
-					filelist = self.smb.conn.listPath(share, subfolder + "*")
-		return filelist
-
-	def _in_ignore_ext_list(self, ext: str) -> bool:
-		'''Return True if file should be ignored based on extension'''
-		ignore = {
-			".bmp", ".eps", ".gif", ".ico", ".jfi", ".jfif", ".jif", ".jpe",
-			".jpeg", ".jpg", ".png", ".psd", ".svg", ".tif", ".tiff", ".webp",
-			".xcf", ".ttf",	".otf", ".lock", ".css", ".less", ".admx", ".adml",
-			".xsd", ".nse", ".xsl"
-		}
-		if ext in ignore:
-			return True
-		return False
-
-	def _not_fp_filename(self, filename: str) -> bool:
-		'''Return true if filename is not an FP'''
-		fname = filename.lower()
-		fps = [
-			"credentialprovider.idl",
-			"pspasswd64.exe",
-			"pspasswd.exe",
-			"psexec.exe",
-			"psexec64.exe",
-			"jmxremote.password.template",
-			"sceregvl.inf"
-		]
-		for fp in fps:
-			if fp == fname:
-				return False
-		return True
+			if "STATUS_ACCESS_DENIED" in error or "STATUS_OBJECT_PATH_NOT_FOUND" in error or "STATUS_NO_SUCH_FILE" in error:
+				return []
+			raise
+		finally:
+			self.connections.release(member)
 
 	def _not_in_fp_folders(self, folder: str) -> bool:
 		'''Return true if folder is not known for FPs'''
-		fps = [
-			r"/puppet/share/doc",
-			r"/lib/ruby",
-			r"/lib/site-packages",
-			r"/usr/share/doc",
-			r"node_modules",
-			r"vendor/bundle",
-			r"vendor/cache",
-			r"/doc/openssl",
-			r"Anaconda3/Lib/test",
-			r"WindowsPowerShell/Modules",
-			r"Python[\d\x2e]{0,4}/Lib",
-			r"Reference Assemblies/Microsoft/Framework/\.NETFramework"
-			r"dotnet/sdk",
-			r"dotnet/shared",
-			r"Modules/Microsoft\.PowerShell\.Security",
-			r"Windows/assembly",
-			r"/winsxs",
-			r"/syswow64",
-			r"/system32",
-			r"/systemapps",
-			r"/windows/servicing",
-			r"/servicing",
-			r"/Microsoft\.NET/Framework",
-			r"/windows/immersivecontrolpanel",
-			r"/windows/diagnostics",
-			r"/windows/debug",
-			r"/locale",
-			r"/chocolatey/helpers",
-			r"/sources/sxs",
-			r"/localization",
-			r"/AppData/Local/Microsoft",
-			r"/AppData/Roaming/Microsoft/Windows",
-			r"/AppData/Roaming/Microsoft/Teams",
-			r"/wsuscontent",
-			r"/Application Data/Microsoft/CLR Security Config",
-			r"/servicing/LCU",
-			r"Windows Kits/10",
-			r"Git/mingw64",
-			r"Git/usr/lib",
-			r"ProgramData/Microsoft/NetFramework/BreadcrumbStore",
-			r"\.MSSQLSERVER/MSSQL/Binn/Templates"
-		]
-		for fp in fps:
-			if re.search(fp, folder, re.I):
-				return False
-		return True
+		return self.folder_filter.accepts(folder)
 
 	def _get_filename(self, filepath: str) -> str:
 		'''Return filename given a full path'''
 		return filepath.split("/")[-1]
 
-	def _get_file_ext(self, filename: str) -> str:
-		'''Return file extension given a file name'''
-		ext = ""
-		if "." in filename:
-			exts = filename.split(".")[1:]
-			ext = "." + ".".join(exts)
-		return ext
-
-	def _spider_folder(self, share_name: str, folder: str) -> None:
-		'''Spider sufolders searching for credentials'''
-		for result in self._list_dir(share_name, folder + "*"):
-			_next = result.get_longname()
-			if _next in [".", ".."]:
-				continue
-			path = folder + _next
+	def _get_file_exts(self, filename: str) -> tuple:
+		'''Return the candidate file extensions given a file name, its last suffix at the end'''
+		return self.compiled.file_exts(filename)
+
+	def _job_priority(self, job: tuple) -> int:
+		'''Return the frontier rank of a job, lower ranks are run first'''
+		# Content scans of files already triaged by name come first
+		if job[0] == "scan":
+			return 0
+		if self.priority_folders and self.priority_folders.search(job[2]):
+			return 1
+		return 2
+
+	def _queue(self, job: tuple) -> None:
+		'''Add a job to the crawl frontier'''
+		if self.state:
+			parent = self._parent_folder(job[2])
+			if parent is not None:
+				with self._track_lock:
+					self._outstanding[(job[1], parent)] += 1
+		self.jobs.put((self._job_priority(job), next(self._job_order), job))
+
+	def _parent_folder(self, path: str) -> str:
+		'''Return the folder holding a file or folder path, None for a share root'''
+		path = path[:-1] if path.endswith("/") else path
+		if not path:
+			return None
+		return path[:path.rindex("/") + 1]
+
+	def _job_done(self, share_name: str, folder: str, complete: bool) -> None:
+		'''Count a finished job against its folder, checkpointing every folder whose subtree is now finished'''
+		if not self.state:
+			return
+		with self._track_lock:
+			while folder is not None:
+				key = (share_name, folder)
+				if not complete:
+					self._incomplete.add(key)
+				count = self._outstanding.get(key, 1) - 1
+				if count > 0:
+					self._outstanding[key] = count
+					return
+				self._outstanding.pop(key, None)
+				# A folder with a skipped or failed job anywhere below it stays unfinished
+				complete = key not in self._incomplete
+				self._incomplete.discard(key)
+				if complete:
+					self.state.finish_folder(self.host, share_name, folder)
+				folder = self._parent_folder(folder)
+
+	def _spider_folder(self, share_name: str, folder: str) -> bool:
+		'''Spider a folder searching for credentials, queueing its subfolders, and return False if cut short'''
+		complete = True
+		listing = [r for r in self._list_dir(share_name, folder + "*") if r.get_longname() not in [".", ".."]]
+		if self.max_dir_entries and len(listing) > self.max_dir_entries:
+			self.logger.debug(f"Only crawling {self.max_dir_entries} of {len(listing)} entries in //{self.host}/{share_name}{folder}")
+			listing = listing[:self.max_dir_entries]
+			complete = False
+		# Files a previous run already finished
+		done = self.state.files_done(self.host, share_name, folder) if self.resume else ()
+		indexed = {}
+		if self.index:
+			indexed = self.index.folder_files(self.host, share_name, folder)
+			signature = hashlib.sha1(repr(sorted((r.get_longname(), r.get_filesize(), r.get_mtime_epoch(), r.is_directory()) for r in listing)).encode()).hexdigest()
+			if self.skip_unchanged_dirs and complete and signature == self.index.signature(self.host, share_name, folder):
+				# Nothing in this folder changed, only its subfolders are crawled
+				done = {r.get_longname() for r in listing if not r.is_directory()}
+		# The listing signature is stored once no file of the folder is waiting on a scan
+		listed = settled = complete
+		# Depth of the subfolders found here, the share root is depth 0
+		depth = folder.count("/")
+		for result in listing:
+			path = folder + result.get_longname()
 			# Folders
 			if result.is_directory():
 				#print(path)
+				if self.max_depth and depth > self.max_depth:
+					# Left unfinished so a resumed crawl with a larger MAX_DEPTH still descends
+					complete = False
+					continue
 				if self._not_in_fp_folders(path):
-					self._spider_folder(share_name, path + "/")
+					self._queue(("folder", share_name, path + "/"))
 			# Files
 			else:
 				#print(path)
+				if result.get_longname() in done:
+					continue
+				if self._over_budget(share_name, path):
+					return False
+				self._spend(share_name, files=1)
 				size = result.get_filesize()
-				if size <= self.max_size: # Maybe implement this in a different spot so filename rules and such can still work
-					filename = self._get_filename(path)
-					if self._not_fp_filename(filename):
-						ext = self._get_file_ext(filename)
-						if not self._in_ignore_ext_list(ext):
-							self._test_file(share_name, path, filename, ext)
+				filename = self._get_filename(path)
+				exts = self._get_file_exts(filename)
+				if not self.compiled.discard.discards(path, filename, exts, size, self.discard_size):
+					if self._test_file(share_name, path, filename, exts, size, result.get_mtime_epoch(), indexed.get(filename)):
+						settled = False
+					continue
+				if self.state:
+					self.state.finish_file(self.host, share_name, path)
+		if self.index and listed:
+			self.index.prune(self.host, share_name, folder, {r.get_longname() for r in listing if not r.is_directory()})
+			if settled:
+				self.index.set_signature(self.host, share_name, folder, signature)
+		return complete
+
+	def _spend(self, share_name: str, nbytes: int = 0, files: int = 0) -> None:
+		'''Count bytes and files against the host and share budgets'''
+		self.host_budget.spend(nbytes, files)
+		self.share_budgets[share_name].spend(nbytes, files)
+
+	def _over_budget(self, share_name: str, path: str, count_files: bool = True) -> bool:
+		'''Return True once the host or share budget is spent, recording where the share stopped'''
+		scope = "host"
+		reason = self.host_budget.exceeded(count_files)
+		if not reason:
+			scope = "share"
+			reason = self.share_budgets[share_name].exceeded(count_files)
+		if not reason:
+			return False
+		with self._stop_lock:
+			if share_name not in self.stopped:
+				self.stopped[share_name] = (scope, reason, path)
+				self.logger.info(f"Stopped crawling //{self.host}/{share_name} at {path}: {scope} {reason} budget spent")
+		return True
+
+	def _run_job(self, job: tuple) -> None:
+		'''Run one folder or content scan job, keeping the checkpoint up to date'''
+		kind, share_name, path = job[:3]
+		parent = self._parent_folder(path)
+		self.share_budgets[share_name].start()
+		# Files already examined still get their content scan under the file limit
+		if self.connections.down or self._over_budget(share_name, path, count_files=kind != "scan"):
+			self._job_done(share_name, parent, False)
+			return
+		if kind == "scan":
+			complete = False
+			try:
+				complete = self._content_scan(*job[1:])
+			finally:
+				self._job_done(share_name, parent, complete)
+			return
+		if self.resume and self.state.folder_done(self.host, share_name, path):
+			self._job_done(share_name, parent, True)
+			return
+		if self.state:
+			with self._track_lock:
+				self._outstanding[(share_name, path)] = 1
+		complete = False
+		try:
+			complete = self._spider_folder(share_name, path)
+		finally:
+			self._job_done(share_name, path, complete)
+
+	def _worker(self) -> None:
+		'''Run folder and content scan jobs from the crawl queue until told to stop'''
+		while True:
+			job = self.jobs.get()[2]
+			try:
+				if job is None:
+					return
+				self._run_job(job)
+			except Exception as e:
+				self.logger.info(f"Error spidering {self.host}: {str(e)}")
+			finally:
+				self.jobs.task_done()
+
+	def _crawl(self, share_names: list) -> None:
+		'''Spider the shares with a pool of workers sharing one priority ordered frontier'''
+		self.jobs = queue.PriorityQueue()
+		self.host_budget.start()
+		for share_name in share_names:
+			self.share_budgets[share_name] = CrawlBudget(*self.share_limits)
+			self._queue(("folder", share_name, "/"))
+		# Workers borrow SMB sessions from the pool, which opens them as they are needed
+		workers = [threading.Thread(target=self._worker, daemon=True) for i in range(self.workers)]
+		for worker in workers:
+			worker.start()
+		self.jobs.join()
+		for worker in workers:
+			self.jobs.put((3, next(self._job_order), None))
+		for worker in workers:
+			worker.join()
+		if self.state:
+			self.state.flush()
+		if self.index:
+			self.index.flush()
+		if self.listings is not None and self.listings.store:
+			self.listings.store.flush()
+		self.connections.close()
+		self.logger.debug(f"Opened {self.connections.opened} extra sessions to {self.host}, reconnected {self.connections.reconnects} times, {self.connections.failed_reconnects} attempts failed")
 
 	def spider_shares(self):
 		'''Enumerate all shares and spider files and folders'''
@@ -1471,26 +3646,22 @@ class CredentialCrawler:
 		try:
 			# Get all available shares for the SMB connection
 			shares = self.smb.shares()
+			crawl = []
+			if self.state and not self.resume:
+				self.state.reset(self.host)
+			if self.index:
+				self.index.check_rules(self.compiled.digest)
 			for share in shares:
 				share_perms = share["access"]
 				share_name = share["name"]
-				if ("READ" in share_perms) or ("WRITE" in share_perms):
-					# Log interesting shares but do not spider
-					if self._is_interesting_share(share_name):
-						self.logger.info(
-							f'<CREDHUNT>{datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}|[Black]|Accessible Interesting Share|//{self.host}/{share_name}|{share_name}</CREDHUNT>'
-						)
-					# exclude shares that are not crawlable
-					elif self._is_crawlable(share_name):
-						try:
-							# Spider the share root
-							self._spider_folder(share_name, "/")
-						except SessionError:
-							self.logger.info(f"Error spidering {self.host}.")
-							self._reconnect()
+				# ShareName rules log and discard shares before any traversal
+				if (("READ" in share_perms) or ("WRITE" in share_perms)) and self._classify_share(share_name):
+					crawl.append(share_name)
+			self._crawl(crawl)
 		except Exception as e:
 			self.logger.info(f"Error enumerating shares ({self.host}): {str(e)}")
-
+		finally:
+			self.writer.flush()
 
 class CMEModule:
 
@@ -1502,15 +3673,130 @@ class CMEModule:
 
 	def __init__(self) -> None:
 		'''Initialize module'''
-		pass
+		self.crawler_options = {}
 
 	def options(self, context, module_options):
-		'''Get module options'''
-		pass
+		'''
+		MAX_FILE_SIZE    Largest file in bytes to content scan, larger files still get name rules (default: 10485760)
+		DISCARD_SIZE     Ignore files larger than this many bytes entirely, 0 for no limit (default: 0)
+		SCAN_BUFFER      Bytes of a file held in memory while content scanning (default: 1048576)
+		READ_SIZE        Bytes per SMB read, capped to the server MaxReadSize (default: 1048576)
+		READ_DEPTH       SMB2/3 read requests kept in flight per file (default: 4)
+		SCAN_HEAD        Only content scan the first N bytes of a file, 0 for the whole file (default: 0)
+		SCAN_TAIL        Also content scan the last N bytes of a file sampled with SCAN_HEAD (default: 0)
+		SNIFF_CONTENT    Skip files whose first block looks binary and content scan UTF-16 text as UTF-8 (default: True)
+		WORKERS          Crawl workers per host, also the most SMB sessions pooled per host (default: 1)
+		RECONNECT_ATTEMPTS Reconnects tried before a host is given up on (default: 5)
+		RECONNECT_DELAY  Seconds before the first reconnect, doubled after every failed one (default: 1)
+		RECONNECT_MAX_DELAY Longest wait in seconds between two reconnects (default: 30)
+		MAX_DEPTH        Deepest folder level to crawl below a share root, 0 for no limit (default: 0)
+		MAX_DIR_ENTRIES  Most entries of one folder to crawl, 0 for no limit (default: 0)
+		PRIORITY_FOLDERS Comma separated folder path regexes crawled first (default: IT, backup, scripts, deploy, .ssh, ...)
+		HOST_TIME_LIMIT  Seconds to crawl one host, 0 for no limit (default: 0)
+		HOST_BYTE_LIMIT  Bytes to download from one host, 0 for no limit (default: 0)
+		HOST_FILE_LIMIT  Files to examine on one host, 0 for no limit (default: 0)
+		SHARE_TIME_LIMIT Seconds to crawl one share, 0 for no limit (default: 0)
+		SHARE_BYTE_LIMIT Bytes to download from one share, 0 for no limit (default: 0)
+		SHARE_FILE_LIMIT Files to examine on one share, 0 for no limit (default: 0)
+		CHECKPOINT       Record finished folders and files so an interrupted crawl can be resumed (default: True)
+		RESUME           Skip what a previous crawl of the host already finished (default: False)
+		STATE_FILE       Checkpoint database (default: credhunt/crawl_state.db in the CME workspace)
+		INCREMENTAL      Only content scan files whose size or write time changed since an earlier run (default: False)
+		SKIP_UNCHANGED_DIRS Skip the files of folders whose listing is unchanged, without reporting them again (default: False)
+		INDEX_FILE       Incremental scan index (default: credhunt/scan_index.db in the CME workspace)
+		DEDUPE           Reuse the findings of files identical to one already scanned on any host (default: True)
+		DEDUPE_TRUST_PRECHECK Treat files with the same size, first and last 4KB as identical without reading them (default: False)
+		OUTPUT_JSONL     Also write findings to this JSON lines file (default: none)
+		OUTPUT_DB        Also write findings to the findings table of this SQLite database (default: none)
+		ARCHIVE_MAX_DEPTH Levels of nested zip based archives to look inside, 0 to leave archives closed (default: 2)
+		ARCHIVE_MAX_MEMBERS Most members of one archive to inspect, 0 for no limit (default: 1000)
+		ARCHIVE_MAX_BYTES Bytes to decompress from one archive and the archives inside it (default: 104857600)
+		EXTRACT_TEXT     Comma separated document extensions whose text is content scanned, none to turn it off (default: .docx, .xlsx, .pptx, .odt, ...)
+		EXTRACT_MAX_BYTES Bytes of text to content scan from one document (default: 10485760)
+		CERT_PASSWORDS   Comma separated passwords tried on PKCS#12 files found by CheckForKeys rules (default: blank, password, mimikatz, ...)
+		LISTING_CACHE    Share folder listings between hosts that are the same server, by name and SMB2 server GUID, under another name (default: True)
+		LISTING_CACHE_MB Memory for cached folder listings in MB (default: 64)
+		LISTING_CACHE_FILE Also keep folder listings in this SQLite database for later runs (default: none)
+		LISTING_CACHE_TTL Seconds a listing kept on disk stays valid (default: 3600)
+		RULE_FILES       Comma separated Snaffler TOML or credhunt JSON rule files and folders to load (default: none)
+		DEFAULT_RULES    Keep the built in rules next to RULE_FILES (default: True)
+		CONSOLE_TRIAGE   Least severe triage level shown on the console, Black, Red, Yellow or Green (default: Green)
+		'''
+		self.crawler_options = {
+			"max_size": int(module_options.get("MAX_FILE_SIZE", 10 * 1024 * 1024)),
+			"discard_size": int(module_options.get("DISCARD_SIZE", 0)),
+			"scan_buffer": int(module_options.get("SCAN_BUFFER", 1024 * 1024)),
+			"read_size": int(module_options.get("READ_SIZE", 1024 * 1024)),
+			"read_depth": int(module_options.get("READ_DEPTH", 4)),
+			"scan_head": int(module_options.get("SCAN_HEAD", 0)),
+			"scan_tail": int(module_options.get("SCAN_TAIL", 0)),
+			"workers": int(module_options.get("WORKERS", 1)),
+			"reconnect_attempts": int(module_options.get("RECONNECT_ATTEMPTS", 5)),
+			"reconnect_delay": float(module_options.get("RECONNECT_DELAY", 1)),
+			"reconnect_max_delay": float(module_options.get("RECONNECT_MAX_DELAY", 30)),
+			"max_depth": int(module_options.get("MAX_DEPTH", 0)),
+			"max_dir_entries": int(module_options.get("MAX_DIR_ENTRIES", 0)),
+			"host_time_limit": int(module_options.get("HOST_TIME_LIMIT", 0)),
+			"host_byte_limit": int(module_options.get("HOST_BYTE_LIMIT", 0)),
+			"host_file_limit": int(module_options.get("HOST_FILE_LIMIT", 0)),
+			"share_time_limit": int(module_options.get("SHARE_TIME_LIMIT", 0)),
+			"share_byte_limit": int(module_options.get("SHARE_BYTE_LIMIT", 0)),
+			"share_file_limit": int(module_options.get("SHARE_FILE_LIMIT", 0)),
+			"archive_max_depth": int(module_options.get("ARCHIVE_MAX_DEPTH", 2)),
+			"archive_max_members": int(module_options.get("ARCHIVE_MAX_MEMBERS", 1000)),
+			"archive_max_bytes": int(module_options.get("ARCHIVE_MAX_BYTES", 100 * 1024 * 1024)),
+			"extract_max_bytes": int(module_options.get("EXTRACT_MAX_BYTES", 10 * 1024 * 1024)),
+			"sniff_content": self._bool_option(module_options, "SNIFF_CONTENT", True),
+			"resume": self._bool_option(module_options, "RESUME", False)
+		}
+		if self._bool_option(module_options, "CHECKPOINT", True):
+			state_file = module_options.get("STATE_FILE", os.path.join(self._workspace_dir(context), "crawl_state.db"))
+			self.crawler_options["state"] = CrawlState(state_file)
+		if self._bool_option(module_options, "INCREMENTAL", False):
+			index_file = module_options.get("INDEX_FILE", os.path.join(self._workspace_dir(context), "scan_index.db"))
+			self.crawler_options["index"] = ScanIndex(index_file)
+			self.crawler_options["skip_unchanged_dirs"] = self._bool_option(module_options, "SKIP_UNCHANGED_DIRS", False)
+		if self._bool_option(module_options, "DEDUPE", True):
+			self.crawler_options["dedupe"] = DedupeCache(trust_precheck=self._bool_option(module_options, "DEDUPE_TRUST_PRECHECK", False))
+		sinks = []
+		if module_options.get("OUTPUT_JSONL"):
+			sinks.append(JSONLSink(module_options["OUTPUT_JSONL"]))
+		if module_options.get("OUTPUT_DB"):
+			sinks.append(SQLiteSink(module_options["OUTPUT_DB"]))
+		self.crawler_options["writer"] = FindingWriter(sinks, module_options.get("CONSOLE_TRIAGE", "Green").capitalize())
+		rule_files = [p for p in module_options.get("RULE_FILES", "").split(",") if p]
+		default_rules = self._bool_option(module_options, "DEFAULT_RULES", True)
+		if rule_files or not default_rules:
+			self.crawler_options["compiled_rules"] = load_compiled_rules(rule_files, default_rules, self._workspace_dir(context))
+		if self._bool_option(module_options, "LISTING_CACHE", True):
+			store = ListingStore(module_options["LISTING_CACHE_FILE"]) if module_options.get("LISTING_CACHE_FILE") else None
+			self.crawler_options["listings"] = ListingCache(int(module_options.get("LISTING_CACHE_MB", 64)) * 1024 * 1024, store, int(module_options.get("LISTING_CACHE_TTL", 3600)))
+		if "EXTRACT_TEXT" in module_options:
+			self.crawler_options["extract_text"] = [e.strip().lower() for e in module_options["EXTRACT_TEXT"].split(",") if e.strip()]
+		if "CERT_PASSWORDS" in module_options:
+			self.crawler_options["cert_passwords"] = module_options["CERT_PASSWORDS"].split(",")
+		if "PRIORITY_FOLDERS" in module_options:
+			self.crawler_options["priority_folders"] = [p for p in module_options["PRIORITY_FOLDERS"].split(",") if p]
+
+	def _bool_option(self, module_options: dict, name: str, default: bool) -> bool:
+		'''Return a true/false module option'''
+		if name not in module_options:
+			return default
+		return str(module_options[name]).lower() in ["true", "yes", "1"]
+
+	def _workspace_dir(self, context) -> str:
+		'''Return the credhunt folder of the current CME workspace, creating it if needed'''
+		try:
+			workspace = context.conf.get("CME", "workspace")
+		except Exception:
+			workspace = "default"
+		path = os.path.join(os.path.expanduser("~/.cme"), "workspaces", workspace, "credhunt")
+		os.makedirs(path, exist_ok=True)
+		return path
 
 	def on_login(self, context, connection):
 		'''Login action is to spider for creds'''
-		spider = CredentialCrawler(connection, context.log)
+		spider = CredentialCrawler(connection, context.log, self.crawler_options)
 		spider.spider_shares()
 
 
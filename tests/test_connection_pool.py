@@ -0,0 +1,78 @@
+#! /usr/bin/env python3
+# Session loss classification against impacket's own exception classes
+# Usage: python3 -m pytest tests
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("impacket")
+from impacket import nmb, nt_errors, smb, smb3, smbconnection
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import credhunt
+
+
+class StubConnection:
+	'''SMB connection answering every listing with one error'''
+
+	def __init__(self, error: Exception = None) -> None:
+		self.error = error
+
+	def getRemoteHost(self) -> str:
+		return "10.0.0.1"
+
+	def listPath(self, share: str, path: str) -> list:
+		raise self.error
+
+
+class StubSMB:
+	'''CME SMB protocol object around a stub connection'''
+
+	def __init__(self, conn: StubConnection) -> None:
+		self.conn = conn
+
+
+class StubLogger:
+	'''Logger collecting info lines'''
+
+	def __init__(self) -> None:
+		self.lines = []
+
+	def info(self, message: str) -> None:
+		self.lines.append(message)
+
+	def debug(self, message: str) -> None:
+		pass
+
+
+def pool() -> credhunt.ConnectionPool:
+	return credhunt.ConnectionPool(StubSMB(StubConnection()), StubLogger())
+
+
+@pytest.mark.parametrize("code", [nt_errors.STATUS_USER_SESSION_DELETED, nt_errors.STATUS_NETWORK_SESSION_EXPIRED, nt_errors.STATUS_NETWORK_NAME_DELETED])
+def test_session_errors_are_lost(code):
+	assert pool().lost(smbconnection.SessionError(code))
+	assert pool().lost(smb3.SessionError(code))
+	# SMB1 errors carry the NT status split into an error class and code
+	assert pool().lost(smb.SessionError("", code & 0xffff, code >> 16, nt_status=1))
+
+
+@pytest.mark.parametrize("code", [nt_errors.STATUS_ACCESS_DENIED, nt_errors.STATUS_FILE_LOCK_CONFLICT, nt_errors.STATUS_END_OF_FILE])
+def test_request_errors_are_not_lost(code):
+	assert not pool().lost(smbconnection.SessionError(code))
+	assert not pool().lost(smb3.SessionError(code))
+
+
+def test_transport_errors_are_lost():
+	assert pool().lost(nmb.NetBIOSError("connection closed"))
+	assert pool().lost(ConnectionResetError())
+	assert not pool().lost(ValueError())
+
+
+def test_access_denied_listing_is_empty():
+	smb_conn = StubSMB(StubConnection(smbconnection.SessionError(nt_errors.STATUS_ACCESS_DENIED)))
+	crawler = credhunt.CredentialCrawler(smb_conn, StubLogger())
+	assert crawler._list_path("data", "/secret/") == []
+	assert crawler.connections.reconnects == 0
@@ -0,0 +1,70 @@
+#! /usr/bin/env python3
+# Servers whose folder listings the listing cache shares
+# Usage: python3 -m pytest tests
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("impacket")
+from impacket import smb3
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import credhunt
+
+
+class StubConnection:
+	'''SMB connection to a server of a given name and GUID'''
+
+	def __init__(self, host: str, name: str, guid: bytes) -> None:
+		self.host = host
+		self.name = name
+		self.server = smb3.SMB3.__new__(smb3.SMB3)
+		self.server._Connection = {"ServerGuid": guid}
+
+	def getRemoteHost(self) -> str:
+		return self.host
+
+	def getServerDNSHostName(self) -> str:
+		return self.name
+
+	def getServerName(self) -> str:
+		return self.name.split(".")[0].upper()
+
+	def getSMBServer(self):
+		return self.server
+
+
+class StubSMB:
+	'''CME SMB protocol object around a stub connection'''
+
+	def __init__(self, conn: StubConnection) -> None:
+		self.conn = conn
+
+
+class StubLogger:
+	'''Logger dropping every line'''
+
+	def info(self, message: str) -> None:
+		pass
+
+	def debug(self, message: str) -> None:
+		pass
+
+
+def server_id(host: str, name: str, guid: bytes) -> str:
+	return credhunt.CredentialCrawler(StubSMB(StubConnection(host, name, guid)), StubLogger()).server_id
+
+
+def test_same_guid_is_shared_across_addresses():
+	guid = bytes(range(1, 17))
+	assert server_id("10.0.0.1", "fs.corp.local", guid) == server_id("10.0.0.2", "fs.corp.local", guid)
+
+
+def test_same_name_without_guid_is_not_shared():
+	assert server_id("10.0.0.1", "nas", b"\0" * 16) != server_id("10.0.0.2", "nas", b"\0" * 16)
+
+
+def test_same_name_with_other_guid_is_not_shared():
+	assert server_id("10.0.0.1", "nas", b"\1" * 16) != server_id("10.0.0.2", "nas", b"\2" * 16)
@@ -0,0 +1,59 @@
+#! /usr/bin/env python3
+# Content rules and the scanners that run them
+# Usage: python3 -m pytest tests
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("impacket")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import credhunt
+
+
+def relay_rules(**patterns) -> dict:
+	'''Return the built in rules plus a relay rule per keyword, named after it'''
+	rules = {category: list(credhunt.RULES[category]) for category in credhunt.RULE_CATEGORIES}
+	rules["Relay"] = dict(credhunt.RULES["Relay"])
+	for name, pattern in patterns.items():
+		rules["Relay"][name] = {"rule": name, "target": credhunt.CONTENT_TARGET, "match_type": "Regex", "action": "Snaffle", "triage": "Red", "wordlist": [pattern]}
+	credhunt.validate_rules(rules)
+	return rules
+
+
+def test_backreference_matches_after_other_rules():
+	compiled = credhunt.CompiledRules(relay_rules(Quoted=rb"(['\"])tok\1"))
+	hits = compiled.scan_content(b"x = 'tok'", ["KeepCmdCredentials", "Quoted"])
+	assert [(rule["rule"], match) for rule, match in hits] == [("Quoted", b"'tok'")]
+
+
+def test_shared_group_names_scan():
+	compiled = credhunt.CompiledRules(relay_rules(First=rb"(?P<v>pw1)", Second=rb"(?P<v>pw2)"))
+	scanner = credhunt.ContentScanner(compiled, ["First", "Second"], 1024)
+	scanner.feed(b"pw2 then pw1")
+	assert sorted(rule["rule"] for rule, _ in scanner.finish()) == ["First", "Second"]
+
+
+def test_default_gates_combine():
+	compiled = credhunt.COMPILED_RULES
+	assert compiled.content_gate(tuple(compiled.relay)) is not None
+
+
+def test_document_text_split_inside_a_character():
+	compiled = credhunt.CompiledRules(relay_rules(Greeting="Grüße: password".encode()))
+	scanner = credhunt.XMLTextScanner(compiled, ["Greeting"], 1024, [1024])
+	document = "<w:p><w:t>Grüße: password</w:t></w:p>".encode()
+	cut = document.index("ü".encode()) + 1
+	scanner.feed(document[:cut])
+	scanner.feed(document[cut:])
+	assert [match for _, match in scanner.finish()] == ["Grüße: password".encode()]
+
+
+def test_compound_and_last_suffix_rules_both_fire():
+	compiled = credhunt.COMPILED_RULES
+	exts = compiled.file_exts("db.pem.bak")
+	assert exts == (".pem.bak", ".bak")
+	rules = [rule["rule"] for rule, _ in compiled.categories["FileExtension"].match_all(exts)]
+	assert "RelayCertByExtension" in rules and "KeepDatabaseByExtension" in rules